@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Inference only agents that play asteroids.Game.
+
+A whisker agent is a NumPy weight file of a policy.py network, exported from
+an evolution_learn.py checkpoint. A frame agent is a TorchScript module
+saved by qnet_learn.py --export. Either is played with:
+
+    python agent.py export checkpoints/ whiskers.npz
+    python asteroids.py --agent whiskers.npz
+
+Agents return an index into asteroids.ACTIONS from act(game), reading
+game.observation or the rendered game.window of the previous frame.
+"""
+import argparse
+import glob
+import json
+import os
+import time
+from collections import deque
+
+import numpy as np
+
+import asteroids
+import policy
+
+
+# Calls of a frame agent's module at load
+WARMUP_CALLS = 3
+
+
+class WhiskerAgent:
+    """
+    One whisker policy evaluated with plain matrix products.
+    """
+    # Whiskers are computed without rendering the game
+    needs_frames = False
+
+    def __init__(self, params, layers=policy.LAYERS):
+        params = np.asarray(params, dtype=np.float32).reshape(1, -1)
+        assert params.shape[1] == policy.n_params(layers), "Parameters don't match the layers %s" % (layers,)
+        self.layers = tuple(layers)
+        # Copies, the views of unflatten would keep strided access into params
+        self.params = [(weights[0].copy(), bias[0].copy()) for weights, bias in policy.unflatten(params, layers)]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an exported agent or the best policy of an evolution_learn.py checkpoint.
+        """
+        data = np.load(path)
+        params = data['params'] if 'params' in data else data['best']
+        return cls(params, tuple(int(n) for n in data['layers']))
+
+    def save(self, path):
+        np.savez(
+            path,
+            params=np.concatenate([np.concatenate([w.ravel(), b]) for w, b in self.params]),
+            layers=np.array(self.layers),
+        )
+
+    def act(self, game):
+        x = policy.observe(game.observation)
+        for i, (weights, bias) in enumerate(self.params):
+            x = x @ weights + bias
+            if i < len(self.params) - 1:
+                x = np.tanh(x)
+        return int(x.argmax())
+
+
+class FrameAgent:
+    """
+    TorchScript Q-network playing on the last downscaled frames, as in qnet_learn.AsteroidsEnv.
+    """
+    needs_frames = True
+
+    def __init__(self, path, threads=1):
+        import torch
+        import qnet_learn
+
+        self.torch = torch
+        self.screen = qnet_learn.screen
+        # A single frame is too small to gain from more threads
+        if threads:
+            torch.set_num_threads(threads)
+        extra_files = {'agent.json': ''}
+        module = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+        # Fuses and prepacks the frozen layers for CPU inference
+        self.module = torch.jit.optimize_for_inference(module)
+        config = json.loads(extra_files['agent.json'])
+        self.frame_size = config['frame_size']
+        self.frames = deque(maxlen=config['history'])
+        self.player = None
+        # TorchScript optimizes the module during its first calls, keep them out of the game
+        state = torch.zeros((1, config['history'], self.frame_size, self.frame_size))
+        with torch.inference_mode():
+            for _ in range(WARMUP_CALLS):
+                self.module(state)
+
+    def act(self, game):
+        frame = self.screen(game.window, self.frame_size)
+        # A new player means the game was reset, start from an empty history
+        if game.player is not self.player:
+            self.player = game.player
+            self.frames.extend(np.zeros_like(frame) for _ in range(self.frames.maxlen))
+        self.frames.append(frame)
+
+        state = self.torch.from_numpy(np.stack(self.frames)[None]).float() / 255
+        with self.torch.inference_mode():
+            return int(self.module(state).argmax(1))
+
+
+def load(path):
+    """
+    Load a whisker agent from .npz files, otherwise a TorchScript frame agent.
+    """
+    if os.path.splitext(path)[1] == '.npz':
+        return WhiskerAgent.load(path)
+    return FrameAgent(path)
+
+
+def export(checkpoint, path):
+    """
+    Export the best policy of an evolution checkpoint, or of the latest one in a directory.
+    """
+    if os.path.isdir(checkpoint):
+        paths = sorted(glob.glob(os.path.join(checkpoint, 'generation_*.npz')))
+        if not paths:
+            raise FileNotFoundError('No checkpoints in %s' % checkpoint)
+        checkpoint = paths[-1]
+    WhiskerAgent.load(checkpoint).save(path)
+    print('Exported %s to %s' % (checkpoint, path))
+
+
+def timing(path, frames):
+    """
+    Print the time spent in act per frame of a headless game.
+    """
+    agent = load(path)
+    game = asteroids.Game(640*2, 480*2, dt=1000 / 60, headless=True)
+    seconds = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        action = agent.act(game)
+        seconds.append(time.perf_counter() - start)
+        game.run_once(action)
+    seconds = np.array(seconds) * 1000
+    print('act: mean %.3f ms, p99 %.3f ms, max %.3f ms' % (
+        seconds.mean(), np.percentile(seconds, 99), seconds.max(),
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and time asteroids agents.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_export = commands.add_parser('export', help="Export a whisker policy from evolution checkpoints")
+    parser_export.add_argument('checkpoint', help="Checkpoint file or directory")
+    parser_export.add_argument('path')
+    parser_time = commands.add_parser('time', help="Time the inference of an agent")
+    parser_time.add_argument('path')
+    parser_time.add_argument('--frames', type=int, default=600)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export(args.checkpoint, args.path)
+    else:
+        timing(args.path, args.frames)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,47 @@
 #!/usr/bin/env python3
+import argparse
+import os
 from itertools import combinations
 import random
 import math
 from collections import namedtuple
 
+import numpy as np
 import pygame
 
+import kernels
 from vector import Vector as Vec
+from collision import CollisionScheduler, swept_time, collide_at
+from profiling import Profiler
 import colors as C
 
 BG_COLOR = C.black
 
+# Bump whenever a change alters how games play out, cached evaluations
+# of evaluate.py are only reused for the same version
+ENV_VERSION = 9
+
+# The player heading is a whole number of HEADING_STEP degrees clockwise
+# from up, so turning never drifts and its trigonometry comes from tables
+HEADING_STEP = 0.5
+HEADINGS = int(360 / HEADING_STEP)
+HEADING_COS = [math.cos(math.radians(heading * HEADING_STEP)) for heading in range(HEADINGS)]
+HEADING_SIN = [math.sin(math.radians(heading * HEADING_STEP)) for heading in range(HEADINGS)]
+# Unit vector of every heading, heading 0 points up
+HEADING_VECTORS = np.array([HEADING_SIN, [-c for c in HEADING_COS]]).T
+# Whisker directions relative to the heading
+WHISKER_HEADINGS = np.arange(0, HEADINGS, HEADINGS // 36)
+
+Action = namedtuple('Action', ['thrust', 'rotate', 'fire'])
+
+# Discrete action space for agents, see Game.act
+ACTIONS = [
+    Action(thrust, rotate, fire)
+    for thrust in (False, True)
+    for rotate in (0, -1, 1)
+    for fire in (False, True)
+]
+
 class Font(pygame.font.Font):
     def render(self, text, antialias, color, background):
         return super().render(text, antialias, color, background)
@@ -26,8 +57,30 @@ def font_constructor(fontpath, size, bold, italic):
 
 
 class Game:
-    def __init__(self, width, height):
+    physics_modes = {'discrete', 'swept', 'event'}
+
+    def __init__(self, width, height, physics='discrete', dt=None, headless=False, profiler=None, render=True):
+        """
+        physics selects how collisions are found: 'discrete' tests overlap once per tick,
+        'swept' tests the motion during the tick and 'event' predicts impact times.
+        dt fixes the timestep in milliseconds instead of following the wall clock.
+        headless renders into a dummy video driver without opening a window.
+        profiler is a profiling.Profiler timing the phases of run_once.
+        render=False skips all drawing, only the whiskers are computed.
+        """
+        assert physics in self.physics_modes, "Physics must be one of %s" % self.physics_modes
+        if headless:
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            # Let worker processes be terminated instead of SDL turning signals into quit events
+            os.environ['SDL_NO_SIGNAL_HANDLERS'] = '1'
         self.width, self.height = width, height
+        self.physics = physics
+        self.dt = dt
+        self.profiler = profiler or Profiler()
+        self.render = render
+        self.recorder = None
+        self.capture = None
+        self.seed = 2
         self.window = pygame.display.set_mode((width, height))
         self.background = pygame.Surface([width, height])
         self.background.fill(BG_COLOR)
@@ -47,34 +100,30 @@ class Game:
         self.running = True
 
     def whiskers(self, draw=True):
-        dist_list = []
         size = 250
-        for angle in range(0, 360, 360//(36)):
-            end = self.player.position + self.player.transform(self.player.vec_from_center(angle,size=size))
-            t_list = [size]
-            for a in self.asteroids:
-                t = a.intercect(self.player.origin, end)
-                if t and t < size:
-                    t_list.append(t)
-
-            dist = min(t_list)
-            dist_list.append(size-dist)
-            if draw:
-                end = self.player.position + self.player.transform(self.player.vec_from_center(angle,size=dist))
-
+        start = self.player.origin
+        start_x, start_y = float(start.x), float(start.y)
+        directions = HEADING_VECTORS[(self.player.heading + WHISKER_HEADINGS) % HEADINGS]
+        ends = (start_x, start_y) + size * directions
+        centers = np.array([tuple(a.origin) for a in self.asteroids], dtype=float).reshape(-1, 2)
+        radii = np.array([a.radius for a in self.asteroids], dtype=float)
+        distances = kernels.whisker_distances(start_x, start_y, ends, centers, radii, size)
+
+        if draw:
+            for end in ((start_x, start_y) + distances[:, None] * directions).tolist():
                 pygame.draw.line(
                     surface=self.window,
                     color=C.red,
-                    start_pos=self.player.origin,
+                    start_pos=(start_x, start_y),
                     end_pos=end,
                     width=2,
                 )
-        return dist_list
+        return (size - distances).tolist()
 
 
 
     def reset(self):
-        random.seed(2)
+        random.seed(self.seed)
         self.groups = []
         self.player = Player(
             pos=[self.width/2, self.height/2],
@@ -84,43 +133,65 @@ class Game:
         self.group(self.player)
         self.asteroids = self.group(Asteroid.random(self.width, self.height) for _ in range(5))
         self.bullets = self.group()
+        # Controls start released, reused games don't carry a held fire into the next one
+        self.fire_held = False
+        self.scheduler = None
+        if self.physics == 'event':
+            self.scheduler = CollisionScheduler(self.asteroids, self.bullets, (self.width, self.height))
+        self.observation = self.whiskers(draw=False)
 
 
     def update(self, dt):
-        self.window.blit(
-            source=self.background,
-            dest=[0, 0],
-        )
-        for group in self.groups:
-            group.update(
-                dt=dt,
-                window_mode=(self.width, self.height),
-                game_mode=self.modes[self.mode],
-            )
-            group.draw(self.window)
+        with self.profiler.phase('update'):
+            for group in self.groups:
+                if self.scheduler is None or group not in self.scheduler.groups:
+                    group.update(
+                        dt=dt,
+                        window_mode=(self.width, self.height),
+                        game_mode=self.modes[self.mode],
+                    )
 
-        score_surface = self.font.render(
-            text='Score: %s' % self.player.score,
-            antialias=False,
-            color=C.white,
-            background=None,
-        )
-        self.window.blit(
-            source=score_surface,
-            dest=[self.width - score_surface.get_rect().width, 0],
-        )
+        if self.render:
+            self.draw()
+        with self.profiler.phase('whiskers'):
+            self.observation = self.whiskers(draw=self.render)
+        if self.render:
+            with self.profiler.phase('flip'):
+                pygame.display.update()
+            if self.capture is not None:
+                with self.profiler.phase('capture'):
+                    self.capture.grab(self.window)
+
+    def draw(self):
+        with self.profiler.phase('draw'):
+            self.window.blit(
+                source=self.background,
+                dest=[0, 0],
+            )
+            for group in self.groups:
+                group.draw(self.window)
 
-        self.window.blit(
-            source=self.font.render(
-                text=self.modes[self.mode],
+        with self.profiler.phase('hud'):
+            score_surface = self.font.render(
+                text='Score: %s' % self.player.score,
                 antialias=False,
                 color=C.white,
                 background=None,
-            ),
-            dest=[0, 0],
-        )
-        self.whiskers()
-        pygame.display.update()
+            )
+            self.window.blit(
+                source=score_surface,
+                dest=[self.width - score_surface.get_rect().width, 0],
+            )
+
+            self.window.blit(
+                source=self.font.render(
+                    text=self.modes[self.mode],
+                    antialias=False,
+                    color=C.white,
+                    background=None,
+                ),
+                dest=[0, 0],
+            )
 
     def group(self, *sprites):
         group = pygame.sprite.Group(*sprites)
@@ -128,68 +199,154 @@ class Game:
         return group
 
 
-    def run_once(self):
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                self.running = False
-
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_UP:
-                    self.player.thrust = True
-                if event.key == pygame.K_LEFT:
-                    self.player.toggle_rotate(-1)
-                if event.key == pygame.K_RIGHT:
-                    self.player.toggle_rotate(1)
-                if event.key == pygame.K_SPACE:
-                    self.bullets.add(Bullet(
-                        pos=self.player.cannon,
-                        velocity=self.player.direction + self.player.velocity),
-                    )
-                if event.key in self.modes:
-                    self.mode = event.key
-
-
-            if event.type == pygame.KEYUP:
-                if event.key == pygame.K_UP:
-                    self.player.thrust = False
-                if event.key == pygame.K_LEFT or event.key == pygame.K_RIGHT:
-                    self.player.toggle_rotate(0)
-
-        dt = self.clock.tick(self.fps)
+    def collided(self, a, b, dt):
+        """
+        Return when during the coming step of dt the sprites touch, or None.
+        Discrete physics only looks at the current positions.
+        """
+        if self.physics in {'swept', 'event'}:
+            return swept_time(a, b, dt, self.modes[self.mode])
+        if pygame.sprite.collide_circle(a, b):
+            return 0.0
+        return None
 
-        for a, b in combinations(self.asteroids, r=2):
-            if pygame.sprite.collide_circle(a, b):
-                a.collide(b)
+    def first_hit(self, bullet, dt):
+        """
+        Return the asteroid that bullet reaches first during the coming step of dt, or None.
+        The bullet is spent on that asteroid, like it is on the first hit of a small step.
+        """
+        first, first_time = None, None
+        # Iterating the group skips asteroids killed by earlier bullets of this step
+        for asteroid in self.asteroids:
+            t = self.collided(bullet, asteroid, dt)
+            if t is not None and (first_time is None or t < first_time):
+                first, first_time = asteroid, t
+        return first
+
+    def died(self, dt):
+        """
+        Return whether the player runs into an asteroid during the coming step of dt.
+        """
+        with self.profiler.phase('death'):
+            return all([
+                not self.player.invincible,
+                pygame.sprite.spritecollideany(
+                    self.player,
+                    self.asteroids,
+                    collided=lambda player, asteroid: self.collided(player, asteroid, dt) is not None,
+                ),
+                self.modes[self.mode] == 'Normal',
+            ])
+
+    def fire(self):
+        self.bullets.add(Bullet(
+            pos=self.player.cannon,
+            velocity=self.player.direction + self.player.velocity),
+        )
 
-        reward = 0
-        for bullet in self.bullets:
-            for asteroid in self.asteroids:
-                if pygame.sprite.collide_circle(bullet, asteroid):
-                    bullet.collide(asteroid, self.asteroids)
-                    reward += 1
+    def act(self, action):
+        """
+        Control the player with an Action or an index of ACTIONS.
+        Like the space key, fire only shoots when it wasn't already held down.
+        """
+        if not isinstance(action, Action):
+            action = ACTIONS[action]
+        if self.player.thrust != action.thrust:
+            self.player.thrust = action.thrust
+        self.player.toggle_rotate(action.rotate)
+        if action.fire and not self.fire_held:
+            self.fire()
+        self.fire_held = action.fire
+
+    def run_once(self, action=None):
+        """
+        Advance the game by one frame, with action from an agent in addition to the keyboard.
+        Returns (reward, die, score).
+        """
+        with self.profiler.phase('events'):
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    self.running = False
+
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_UP:
+                        self.player.thrust = True
+                    if event.key == pygame.K_LEFT:
+                        self.player.toggle_rotate(-1)
+                    if event.key == pygame.K_RIGHT:
+                        self.player.toggle_rotate(1)
+                    if event.key == pygame.K_SPACE:
+                        self.fire()
+                    if event.key in self.modes:
+                        self.mode = event.key
+
+
+                if event.type == pygame.KEYUP:
+                    if event.key == pygame.K_UP:
+                        self.player.thrust = False
+                    if event.key == pygame.K_LEFT or event.key == pygame.K_RIGHT:
+                        self.player.toggle_rotate(0)
+
+            if action is not None:
+                self.act(action)
+
+        if self.dt:
+            self.clock.tick()
+            dt = self.dt
+        else:
+            dt = self.clock.tick(self.fps)
+
+        if self.scheduler is not None:
+            # The scheduler moves the asteroids through dt, the player is swept against where they start
+            die = self.died(dt)
+
+        if self.scheduler is None:
+            with self.profiler.phase('asteroid_collisions'):
+                for a, b in combinations(self.asteroids, r=2):
+                    t = self.collided(a, b, dt)
+                    if t is not None:
+                        collide_at(a, b, t, self.modes[self.mode])
+
+            reward = 0
+            with self.profiler.phase('bullet_collisions'):
+                for bullet in self.bullets:
+                    if self.physics == 'discrete':
+                        for asteroid in self.asteroids:
+                            if self.collided(bullet, asteroid, dt) is not None:
+                                bullet.collide(asteroid, self.asteroids)
+                                reward += 1
+                    else:
+                        asteroid = self.first_hit(bullet, dt)
+                        if asteroid is not None:
+                            bullet.collide(asteroid, self.asteroids)
+                            reward += 1
+        else:
+            # Moves asteroids and bullets through dt, so update() leaves them alone
+            with self.profiler.phase('scheduler'):
+                reward = self.scheduler.advance(dt, self.modes[self.mode])
 
         self.player.score += reward
-        die = all([
-            not self.player.invincible,
-            pygame.sprite.spritecollideany(
-                self.player,
-                self.asteroids,
-                collided=pygame.sprite.collide_circle,
-            ),
-            self.modes[self.mode] == 'Normal',
-        ])
+        if self.scheduler is None:
+            die = self.died(dt)
 
         if die:
             self.reset()
 
         self.update(dt)
+        if self.recorder is not None:
+            with self.profiler.phase('record'):
+                self.recorder.record(self, action, reward, die)
+        self.profiler.frame()
 
         return reward, die, self.player.score
 
 
-    def run_forever(self):
+    def run_forever(self, agent=None):
+        """
+        Play until the window is closed, with the actions of agent when given, see agent.py.
+        """
         while self.running is True:
-            self.run_once()
+            self.run_once(None if agent is None else agent.act(self))
 
 
 class Object(pygame.sprite.Sprite):
@@ -250,22 +407,18 @@ class Object(pygame.sprite.Sprite):
     def y(self, value):
         self.position = self.x, value
 
+    def moving(self, game_mode):
+        return game_mode != 'Freeze all'
+
     def move(self, **kwargs):
-        if kwargs['game_mode'] != 'Freeze all':
+        if self.moving(kwargs['game_mode']):
             self.position += self.velocity * kwargs['dt']
 
     def wall_collision(self, **kwargs):
         max_width, max_height = kwargs['window_mode']
-        width, height = self.image.get_width(), self.image.get_height()
-        if self.x > max_width - (width / 2):
-            self.x = -(width / 2)
-        elif self.x < -(width / 2):
-            self.x = max_width - (width / 2)
-
-        if self.y > max_height - (height / 2):
-            self.y = -(height / 2)
-        elif self.y < -(height / 2):
-            self.y = max_height - (height / 2)
+        x, y = kernels.wrap(self.x, self.y, self.image.get_width(), self.image.get_height(), max_width, max_height)
+        if x != self.x or y != self.y:
+            self.position = x, y
 
     def update(self, **kwargs):
         self.wall_collision(**kwargs)
@@ -325,6 +478,8 @@ Line = namedtuple('Line', ['color', 'start_pos', 'end_pos', 'width'])
 class Player(Object):
     _max_speed = 0.7
     _acceleration = 0.0005
+    # Rotated ship lines and cannon of every (radius, heading, thrust), shared by all players
+    _geometry = {}
 
 
     def vec_from_center(self, theta, size=False):
@@ -341,10 +496,10 @@ class Player(Object):
 
     def __init__(self, pos, velocity, radius):
         super().__init__(pos, velocity, radius)
-        self.axis = Vec(0, -1)
-        self.direction = Vec(0, -1)
+        self.heading = 0
         self._thrust = False
         self.rotate_speed = 0.0
+        self.rotate_steps = 0
         self.score = 0
         self.invincible = 200
 
@@ -405,6 +560,7 @@ class Player(Object):
         assert value in {1,-1, 0}, "Rotation can be turned on with 1, swap direction with -1 and stopped with 0"
         speed = 3.5
         self.rotate_speed = speed * value
+        self.rotate_steps = round(self.rotate_speed / HEADING_STEP)
 
     @property
     def thrust(self):
@@ -412,7 +568,17 @@ class Player(Object):
 
     @property
     def cannon(self):
-        return self.position + self.transform(Vec(self.radius, 0))
+        return self.position + self.geometry()[1]
+
+    @property
+    def direction(self):
+        x, y = HEADING_VECTORS[self.heading].tolist()
+        return Vec(x, y)
+
+    @direction.setter
+    def direction(self, value):
+        angle = math.degrees(math.atan2(value[0], -value[1]))
+        self.heading = round(angle / HEADING_STEP) % HEADINGS
 
     @thrust.setter
     def thrust(self, value):
@@ -425,7 +591,26 @@ class Player(Object):
         Return a rotated vec around local origin.
         i.e. apply self.angle
         """
-        return vec.rotate_origin(self.angle(), origin=Vec(self.radius, self.radius))
+        cos, sin = HEADING_COS[self.heading], HEADING_SIN[self.heading]
+        x, y = vec[0] - self.radius, vec[1] - self.radius
+        return Vec(cos*x - sin*y + self.radius, sin*x + cos*y + self.radius)
+
+    def geometry(self):
+        """
+        Return (lines, cannon) transformed to the current heading, computed once per heading.
+        """
+        key = self.radius, self.heading, self.thrust
+        geometry = self._geometry.get(key)
+        if geometry is None:
+            lines = self.standby_lines + (self.thrust_lines if self.thrust else [])
+            geometry = self._geometry[key] = (
+                [
+                    Line(line.color, tuple(self.transform(line.start_pos)), tuple(self.transform(line.end_pos)), line.width)
+                    for line in lines
+                ],
+                self.transform(Vec(self.radius, 0)),
+            )
+        return geometry
 
     def update(self, **kwargs):
         super().update(**kwargs)
@@ -439,22 +624,23 @@ class Player(Object):
         super().draw()
         if self.invincible:
             pygame.draw.circle(self.image, (self.invincible, self.invincible, self.invincible), (self.radius, self.radius), self.radius)
-        lines = self.standby_lines[:]
-        if self.thrust:
-            lines += self.thrust_lines[:]
-
-        for line in lines:
+        for line in self.geometry()[0]:
             pygame.draw.line(
                 surface=self.image,
                 color=line.color,
-                start_pos=self.transform(line.start_pos),
-                end_pos=self.transform(line.end_pos),
+                start_pos=line.start_pos,
+                end_pos=line.end_pos,
                 width=line.width,
             )
 
 
     def angle(self, radians=False):
-        angle = self.axis.directional_angle2D(self.direction, radians=radians)
+        """
+        Heading clockwise from up, between -180 and 180 degrees.
+        """
+        angle = (self.heading * HEADING_STEP + 180) % 360 - 180
+        if radians:
+            return math.radians(angle)
         return angle
 
     def move(self, **kwargs):
@@ -464,45 +650,23 @@ class Player(Object):
             if (self.velocity + dv).norm() < self._max_speed:
                 self.velocity += dv
 
-        if self.rotate_speed:
-            self.direction = self.direction.rotate(self.rotate_speed).normalize()
+        if self.rotate_steps:
+            self.heading = (self.heading + self.rotate_steps) % HEADINGS
             self.draw()
 
 class Asteroid(Object):
 
     def intercect(self, ray_start, ray_stop):
-        d = (ray_stop - ray_start).normalize()
-        f = ray_start - self.origin
-
-        a = d * d
-        b = 2 * (f * d)
-        c = (f*f) - self.radius**2
-        discriminant = b**2 - 4*a*c
-        if discriminant < 0:
-            return 0
-
-        discriminant = math.sqrt( discriminant )
-        t1 = (-b - discriminant)/(2*a)
-        t2 = (-b + discriminant)/(2*a)
-        if t1 >= 0:
-            t = t1
-        elif t2 >= 0:
-            t = t2
-        else:
-            t = 0
-
-        return t
+        origin = self.origin
+        return kernels.intersect(*ray_start, *ray_stop, *origin, self.radius)
 
 
     def __init__(self, pos, velocity, radius):
         super().__init__(pos, velocity, radius)
         self.mass = 2*math.pi*radius
 
-    def move(self, **kwargs):
-        if kwargs['game_mode'] == 'Freeze asteroids':
-            return
-
-        return super().move(**kwargs)
+    def moving(self, game_mode):
+        return game_mode not in {'Freeze all', 'Freeze asteroids'}
 
     def draw(self):
         super().draw()
@@ -520,36 +684,49 @@ class Asteroid(Object):
         )
 
     def collide(self, other):
-        normal = (self.origin - other.origin).normalize()
-        overlap = (self.radius + other.radius) - (self.origin - other.origin).norm()
-        tangent = normal.perpendicular()
-
-        self.position += normal * overlap / 2
-        other.position -= normal * overlap / 2
+        # Elastic response along the collision normal, see kernels.collide
+        shift_x, shift_y, vx1, vy1, vx2, vy2 = kernels.collide(
+            *self.origin, *self.velocity, self.radius, self.mass,
+            *other.origin, *other.velocity, other.radius, other.mass,
+        )
+        shift = Vec(shift_x, shift_y)
+        self.position += shift
+        other.position -= shift
 
         assert (self.origin - other.origin).norm() - (self.radius + other.radius) < 1e-10, \
             "Collision between asteroids left them overlapping."
 
-        v1n = normal * self.velocity
-        v2n = normal * other.velocity
-        v1t = tangent * self.velocity
-        v2t = tangent * other.velocity
-
-        # Calculate new velocity scalars on the collision normal
-        normal_speed1 = normal * (v1n * (self.mass - other.mass) + 2 * other.mass * v2n) / (self.mass + other.mass)
-        normal_speed2 = normal * (v2n * (other.mass - self.mass) + 2 * self.mass * v1n) / (self.mass + other.mass)
-
-        # Tangent velocity stays the same
-        tangent_speed1 = v1t * tangent
-        tangent_speed2 = v2t * tangent
-
-        self.velocity = normal_speed1 + tangent_speed1
-        other.velocity = normal_speed2 + tangent_speed2
+        self.velocity = Vec(vx1, vy1)
+        other.velocity = Vec(vx2, vy2)
 
 
 def main():
-    game = Game(640*2, 480*2)
-    game.run_forever()
+    parser = argparse.ArgumentParser(description="Play asteroids.")
+    parser.add_argument('--physics', choices=sorted(Game.physics_modes), default='discrete')
+    parser.add_argument('--dt', type=float, help="Fixed timestep in milliseconds")
+    parser.add_argument('--profile', type=int, metavar='FRAMES', help="Print phase timings every FRAMES frames")
+    parser.add_argument('--record', metavar='FILE', help="Record the game for replay.py")
+    parser.add_argument('--capture', metavar='PATH', help="Save the frames into a directory or a video file")
+    parser.add_argument('--agent', metavar='FILE', help="Let an exported agent play, see agent.py")
+    args = parser.parse_args()
+    profiler = Profiler(enabled=bool(args.profile), dump_every=args.profile or 0)
+    game = Game(640*2, 480*2, physics=args.physics, dt=args.dt, profiler=profiler)
+    if args.record:
+        from replay import TrajectoryRecorder
+        game.recorder = TrajectoryRecorder(args.record, game)
+    if args.capture:
+        from capture import FrameCapture
+        game.capture = FrameCapture(args.capture, game.window.get_size(), fps=game.fps)
+    agent = None
+    if args.agent:
+        from agent import load
+        agent = load(args.agent)
+    game.run_forever(agent)
+    if game.recorder is not None:
+        game.recorder.close()
+    if game.capture is not None:
+        print('Dropped %s of %s frames' % (game.capture.dropped, game.capture.dropped + game.capture.captured))
+        game.capture.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the simulation hot paths.
+
+Run all suites and write the results as json:
+    python benchmark.py --output bench.json
+
+Compare against the results of an earlier commit:
+    python benchmark.py --output new.json --compare bench.json
+
+The learner suite measures gradient updates per second of qnet_learn:
+    python benchmark.py --suites learner --threads 4
+"""
+import argparse
+import json
+import math
+import platform
+import random
+import subprocess
+import sys
+import time
+from itertools import combinations
+
+import numpy as np
+import pygame
+
+import asteroids
+from vector import Vector as Vec
+
+
+COUNTS = [5, 10, 50, 100, 500]
+WIDTH, HEIGHT = 640*2, 480*2
+# Share of the window covered by the asteroids of populate
+FILL = 0.3
+# Random positions tried for an asteroid before accepting an overlap
+PLACE_TRIES = 100
+
+
+def measure(function, min_time, setup=None, max_time=math.inf):
+    """
+    Call function until min_time seconds have been spent in it,
+    or until max_time seconds have passed in total, setup included.
+    setup is called untimed before every call when given.
+    Return (calls, seconds).
+    """
+    calls = 0
+    elapsed = 0.0
+    deadline = time.perf_counter() + max_time
+    while elapsed < min_time and (not calls or time.perf_counter() < deadline):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        elapsed += time.perf_counter() - start
+        calls += 1
+    return calls, elapsed
+
+
+def populate(game, n_asteroids, n_bullets, fill=FILL):
+    """
+    Replace the sprites of game with n_asteroids asteroids and n_bullets bullets.
+
+    Bullets don't expire, but like asteroids they still die on hits, and hit
+    asteroids split, see refill. With a fill, asteroids are shrunk to cover at
+    most that share of the window and placed apart, so that the counts measure
+    steps of a game rather than a pile of overlaps. Without one they keep the
+    sizes and positions of Asteroid.random.
+    """
+    random.seed(0)
+    game.asteroids.empty()
+    game.bullets.empty()
+    placed = []
+    for _ in range(n_asteroids):
+        asteroid = asteroids.Asteroid.random(game.width, game.height)
+        if fill is not None:
+            max_radius = math.sqrt(fill * game.width * game.height / (math.pi * max(n_asteroids, 1)))
+            radius = min(asteroid.radius, max_radius)
+            for _ in range(PLACE_TRIES):
+                x, y = random.uniform(0, game.width), random.uniform(0, game.height)
+                if all((x - ox)**2 + (y - oy)**2 > (radius + other_radius)**2 for ox, oy, other_radius in placed):
+                    break
+            placed.append((x, y, radius))
+            asteroid = asteroids.Asteroid(pos=[0, 0], velocity=asteroid.velocity, radius=radius)
+            asteroid.origin = (x, y)
+        game.asteroids.add(asteroid)
+    for _ in range(n_bullets):
+        bullet = asteroids.Bullet(
+            pos=[random.uniform(0, game.width), random.uniform(0, game.height)],
+            velocity=Vec(0, -1).rotate(random.uniform(0, 360)),
+        )
+        bullet.ttl = math.inf
+        game.bullets.add(bullet)
+
+
+def refill(game, n_asteroids, n_bullets):
+    """
+    Return a setup for measure that populates game again whenever a step has
+    changed its sprite counts, so that every timed step runs with the counts reported.
+    """
+    def setup():
+        if len(game.asteroids) != n_asteroids or len(game.bullets) != n_bullets:
+            populate(game, n_asteroids, n_bullets)
+            # Event physics predicts the new sprites here rather than in the timed step
+            if game.scheduler is not None:
+                game.scheduler.sync()
+    return setup
+
+
+def make_game(physics):
+    game = asteroids.Game(WIDTH, HEIGHT, physics=physics, dt=1000 / 60, headless=True)
+    # God mode keeps the sprite counts from being reset when the player dies
+    game.mode = pygame.K_2
+    return game
+
+
+def bench_game_steps(args, physics):
+    game = make_game(physics)
+    for n_asteroids in args.counts:
+        for n_bullets in args.counts:
+            game.reset()
+            populate(game, n_asteroids, n_bullets)
+            calls, seconds = measure(
+                game.run_once, args.min_time, setup=refill(game, n_asteroids, n_bullets), max_time=args.max_time,
+            )
+            yield dict(asteroids=n_asteroids, bullets=n_bullets, physics=physics), calls, seconds
+
+
+def bench_whiskers(args):
+    game = make_game('discrete')
+    for n_asteroids in args.counts:
+        populate(game, n_asteroids, 0)
+        calls, seconds = measure(lambda: game.whiskers(draw=False), args.min_time, max_time=args.max_time)
+        yield dict(asteroids=n_asteroids), calls, seconds
+
+
+def bench_asteroid_pairs(args):
+    game = make_game('discrete')
+    # Event physics predicts impacts instead of testing pairs
+    for physics in sorted(asteroids.Game.physics_modes - {'event'}):
+        game.physics = physics
+        for n_asteroids in args.counts:
+            populate(game, n_asteroids, 0)
+            dt = game.dt
+
+            def pairs():
+                for a, b in combinations(game.asteroids, r=2):
+                    game.collided(a, b, dt)
+
+            calls, seconds = measure(pairs, args.min_time, max_time=args.max_time)
+            yield dict(asteroids=n_asteroids, physics=physics), calls, seconds
+
+
+def bench_bullet_split(args):
+    game = make_game('discrete')
+    for n_bullets in args.counts:
+        # Asteroid.random sizes, asteroids of populate's fill at high counts are too small to split
+        def split():
+            for bullet, asteroid in zip(list(game.bullets), list(game.asteroids)):
+                bullet.collide(asteroid, game.asteroids)
+
+        calls, seconds = measure(
+            split, args.min_time, setup=lambda: populate(game, n_bullets, n_bullets, fill=None), max_time=args.max_time,
+        )
+        # One call splits n_bullets asteroids
+        yield dict(bullets=n_bullets), calls * n_bullets, seconds
+
+
+def bench_vector(args):
+    random.seed(0)
+    a = Vec(random.random(), random.random())
+    b = Vec(random.random(), random.random())
+    operations = {
+        'add': lambda: a + b,
+        'sub': lambda: a - b,
+        'dot': lambda: a * b,
+        'scale': lambda: a * 0.5,
+        'norm': a.norm,
+        'normalize': a.normalize,
+        'rotate': lambda: a.rotate(3.5),
+        'rotate_origin': lambda: a.rotate_origin(3.5, origin=b),
+        'directional_angle2D': lambda: a.directional_angle2D(b),
+    }
+    for name, operation in operations.items():
+        calls, seconds = measure(operation, args.min_time, max_time=args.max_time)
+        yield dict(operation=name), calls, seconds
+
+
+def bench_learner(args):
+    try:
+        import torch
+        import qnet_learn
+    except ImportError:
+        print('learner suite needs torch, skipped')
+        return
+    qnet_learn.configure_threads(args.threads)
+    configurations = [
+        dict(channels_last=False),
+        dict(channels_last=True),
+    ]
+    if qnet_learn.bfloat16_supported():
+        configurations.append(dict(channels_last=True, bfloat16=True))
+    configurations.append(dict(channels_last=True, compile=True))
+
+    rng = np.random.default_rng(0)
+    frame_shape = (qnet_learn.FRAME_SIZE, qnet_learn.FRAME_SIZE)
+    frames = rng.integers(256, size=(qnet_learn.BATCH_SIZE * 8,) + frame_shape, dtype=np.uint8)
+    for options in configurations:
+        torch.manual_seed(0)
+        learner = qnet_learn.Learner(len(asteroids.ACTIONS), **options)
+        for i, frame in enumerate(frames):
+            learner.memory.push(frame, i % len(asteroids.ACTIONS), 1.0, i % 200 == 199)
+        # Warm up, compilation happens on the first calls
+        for _ in range(3):
+            learner.optimize_model()
+        calls, seconds = measure(learner.optimize_model, args.min_time, max_time=args.max_time)
+        params = dict(channels_last=False, bfloat16=False, compile=False, threads=torch.get_num_threads())
+        params.update(options)
+        yield params, calls, seconds
+
+
+SUITES = {
+    'game_steps': lambda args: (
+        row for physics in sorted(asteroids.Game.physics_modes) for row in bench_game_steps(args, physics)
+    ),
+    'whiskers': bench_whiskers,
+    'asteroid_pairs': bench_asteroid_pairs,
+    'bullet_split': bench_bullet_split,
+    'vector': bench_vector,
+    'learner': bench_learner,
+}
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def key(result):
+    return tuple(sorted((k, v) for k, v in result.items() if k not in {'calls', 'seconds', 'per_second'}))
+
+
+def compare(results, path, threshold):
+    with open(path) as f:
+        old = {key(r): r for r in json.load(f)['results']}
+
+    print('\nCompared with %s:' % path)
+    for result in results:
+        previous = old.get(key(result))
+        if previous is None or not previous['per_second']:
+            continue
+        ratio = result['per_second'] / previous['per_second']
+        flag = ''
+        if ratio < 1 - threshold:
+            flag = '  SLOWER'
+        elif ratio > 1 + threshold:
+            flag = '  faster'
+        print('%-60s %8.2fx%s' % (dict(key(result)), ratio, flag))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the asteroids simulation.")
+    parser.add_argument('--suites', nargs='+', choices=sorted(SUITES), default=sorted(SUITES))
+    parser.add_argument('--counts', nargs='+', type=int, default=COUNTS, help="Asteroid and bullet counts")
+    parser.add_argument('--min-time', type=float, default=0.5, help="Seconds spent on each measurement")
+    parser.add_argument('--max-time', type=float, default=5.0,
+                        help="Seconds after which a slow measurement stops early, setup included. "
+                             "A single call is never interrupted")
+    parser.add_argument('--threads', type=int, help="Torch threads of the learner suite")
+    parser.add_argument('--output', help="Write the results as json to this file")
+    parser.add_argument('--compare', help="Json results of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Relative change reported by --compare")
+    args = parser.parse_args()
+
+    results = []
+    for suite in args.suites:
+        for params, calls, seconds in SUITES[suite](args):
+            result = dict(
+                suite=suite,
+                calls=calls,
+                seconds=seconds,
+                per_second=calls / seconds if seconds else None,
+                **params
+            )
+            results.append(result)
+            print('%-14s %-50s %12.1f /s' % (suite, params, result['per_second'] or 0.0))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(
+                commit=commit(),
+                time=time.time(),
+                python=sys.version.split()[0],
+                pygame=pygame.version.ver,
+                platform=platform.platform(),
+                results=results,
+            ), f, indent=2)
+
+    if args.compare:
+        compare(results, args.compare, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
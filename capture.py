@@ -0,0 +1,126 @@
+"""
+Background capture of rendered frames.
+
+    game.capture = FrameCapture('frames/', game.window.get_size())
+    ...
+    game.capture.close()
+
+Frames are written as a png sequence into a directory, or as a video when
+the path has a video extension and imageio is installed.
+"""
+import multiprocessing
+import os
+import queue
+
+import numpy as np
+import pygame
+
+try:
+    import imageio
+except ImportError:
+    imageio = None
+
+
+VIDEO_EXTENSIONS = {'.mp4', '.avi', '.mkv', '.gif'}
+# Bytes per pixel of the pooled frames, RGB and a padding byte
+PIXEL_BYTES = 4
+# Scheduling priority the writer process lowers itself by
+WRITER_NICENESS = 19
+
+
+class FrameCapture:
+    """
+    Blit frames into a fixed pool of buffers shared with a writer process that encodes them.
+
+    grab() only blits and never waits for the writer: when every buffer is
+    still queued for writing the frame is dropped and counted in self.dropped.
+    Encoding runs in its own process, so a slow encoder drops frames instead
+    of slowing down the game.
+    """
+
+    def __init__(self, path, size, max_queue=64, fps=60):
+        self.path = path
+        self.fps = fps
+        self.captured = 0
+        self.dropped = 0
+
+        if os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS:
+            if imageio is None:
+                raise ImportError("Writing video requires imageio, capture into a directory instead")
+        else:
+            os.makedirs(path, exist_ok=True)
+
+        width, height = size
+        frame_bytes = width * height * PIXEL_BYTES
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.RawArray('B', max_queue * frame_bytes)
+        pool = memoryview(self.pool).cast('B')
+        # Surfaces over the shared pool, blitting into them is a plain copy at most converting pixels
+        self.surfaces = [
+            pygame.image.frombuffer(pool[i * frame_bytes:(i + 1) * frame_bytes], size, 'RGBX')
+            for i in range(max_queue)
+        ]
+        self.free = context.Queue()
+        for slot in range(max_queue):
+            self.free.put(slot)
+        self.frames = context.Queue()
+        self.process = context.Process(
+            target=write_frames,
+            args=(path, size, fps, self.pool, self.frames, self.free),
+            daemon=True,
+        )
+        self.process.start()
+
+    def grab(self, surface):
+        """
+        Queue the current contents of surface, return False if the frame was dropped.
+        """
+        try:
+            slot = self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return False
+
+        self.surfaces[slot].blit(surface, (0, 0))
+        self.frames.put((self.captured, slot))
+        self.captured += 1
+        return True
+
+    def close(self):
+        """
+        Write the queued frames and stop the writer process.
+        Returns the number of dropped frames.
+        """
+        self.frames.put(None)
+        self.process.join()
+        return self.dropped
+
+
+def write_frames(path, size, fps, pool, frames, free):
+    """
+    Encode the frames queued as (index, slot) into path until None comes, handing the slots back through free.
+    """
+    # Leave the CPU to the game first, with few cores a busy writer would otherwise slow it down
+    if hasattr(os, 'nice'):
+        os.nice(WRITER_NICENESS)
+    width, height = size
+    frame_bytes = width * height * PIXEL_BYTES
+    video = imageio.get_writer(path, fps=fps) if os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS else None
+    try:
+        while True:
+            item = frames.get()
+            if item is None:
+                break
+            index, slot = item
+            pixels = np.frombuffer(pool, np.uint8, frame_bytes, slot * frame_bytes).reshape(height, width, PIXEL_BYTES)
+            if video is not None:
+                video.append_data(pixels[:, :, :3])
+            else:
+                pygame.image.save(
+                    pygame.image.frombuffer(pixels, size, 'RGBX'),
+                    os.path.join(path, 'frame_%07d.png' % index),
+                )
+            free.put(slot)
+    finally:
+        if video is not None:
+            video.close()
@@ -0,0 +1,539 @@
+"""
+Swept and event driven collision detection for asteroids.py.
+
+Check that overlapping sprites are resolved without stalling the event
+physics, and that large steps don't miss contacts, with:
+
+    python collision.py --asteroids 100
+"""
+import argparse
+import heapq
+import itertools
+import math
+import time
+from collections import namedtuple
+
+from vector import Vector as Vec
+
+
+Event = namedtuple('Event', ['time', 'seq', 'kind', 'a', 'b', 'versions'])
+
+# Events between two sprites, the rest carry a wall axis or nothing in Event.b
+PAIR_EVENTS = {'collide', 'hit'}
+COMPACT_SIZE = 4096
+# Milliseconds ahead that CollisionScheduler predicts contacts
+HORIZON = 100
+# Side in pixels of the cells of Grid
+CELL_SIZE = 128
+
+
+def time_of_impact(p1, v1, p2, v2, distance, contact=False):
+    """
+    Return the earliest time t >= 0 when two points moving in straight lines
+    come within distance of each other, or None if they never do.
+    Points that are already overlapping count as touching only while approaching,
+    or whatever their velocities with contact=True.
+    """
+    dx, dy = p1[0] - p2[0], p1[1] - p2[1]
+    dvx, dvy = v1[0] - v2[0], v1[1] - v2[1]
+    b = dx*dvx + dy*dvy
+    c = dx*dx + dy*dy - distance*distance
+    if c <= 0 and (contact or b < 0):
+        return 0.0
+    if b >= 0:
+        # Separating or standing still relative to each other
+        return None
+
+    a = dvx*dvx + dvy*dvy
+    discriminant = b*b - a*c
+    if discriminant < 0:
+        return None
+    return (-b - math.sqrt(discriminant)) / a
+
+
+def wall_time(sprite, velocity, window_mode):
+    """
+    Return (time, axis) of the next wrap done by Object.wall_collision
+    for a sprite moving with velocity, or None if it never wraps.
+    """
+    size = sprite.image.get_width(), sprite.image.get_height()
+    best = None
+    for axis in (0, 1):
+        speed = velocity[axis]
+        if speed > 0:
+            t = (window_mode[axis] - size[axis] / 2 - sprite.position[axis]) / speed
+        elif speed < 0:
+            t = (-(size[axis] / 2) - sprite.position[axis]) / speed
+        else:
+            continue
+        t = max(t, 0.0)
+        if best is None or t < best[0]:
+            best = (t, axis)
+    return best
+
+
+def wrap(sprite, axis, velocity, window_mode):
+    """
+    Move a sprite sitting on a wall to the opposite side, the same way as Object.wall_collision.
+    """
+    size = sprite.image.get_width(), sprite.image.get_height()
+    position = list(sprite.position)
+    if velocity[axis] > 0:
+        position[axis] = -(size[axis] / 2)
+    else:
+        position[axis] = window_mode[axis] - (size[axis] / 2)
+    sprite.position = position
+
+
+class Grid:
+    """
+    Sprites bucketed by the cell of their origin, with the largest radius and speed put in.
+    """
+
+    def __init__(self, size=CELL_SIZE):
+        self.size = size
+        self.cells = {}
+        self.cell = {}
+        self.max_radius = 0.0
+        self.max_speed = 0.0
+
+    def move(self, sprite, x, y, speed):
+        cell = (int(x // self.size), int(y // self.size))
+        old = self.cell.get(sprite)
+        if old != cell:
+            if old is not None:
+                del self.cells[old][sprite]
+            # Dicts keep the sprites in insertion order, sets would iterate by id
+            self.cells.setdefault(cell, {})[sprite] = None
+            self.cell[sprite] = cell
+        self.max_radius = max(self.max_radius, sprite.radius)
+        self.max_speed = max(self.max_speed, speed)
+
+    def remove(self, sprite):
+        cell = self.cell.pop(sprite, None)
+        if cell is not None:
+            del self.cells[cell][sprite]
+
+    def near(self, x, y, distance):
+        """
+        Yield the sprites put in at most distance away from (x, y), and some further ones.
+        """
+        size = self.size
+        rows = range(int((y - distance) // size), int((y + distance) // size) + 1)
+        for i in range(int((x - distance) // size), int((x + distance) // size) + 1):
+            for j in rows:
+                cell = self.cells.get((i, j))
+                if cell:
+                    yield from cell
+
+
+class CollisionScheduler:
+    """
+    Event-driven physics for asteroids and bullets.
+
+    Asteroids and bullets move in straight lines between events, so the next
+    wall wrap, asteroid-asteroid contact, bullet hit and bullet expiry can be
+    predicted analytically and kept in a priority queue. When a sprite changes
+    its velocity or position only the predictions involving it are redone,
+    older events are recognized as stale by their version numbers.
+
+    Sprites are only moved when an event involves them and at the end of an
+    advance, in between their motion is kept as floats. Predictions look
+    HORIZON milliseconds ahead and a horizon event predicts the sprite again
+    once it runs out. Only sprites in grid cells within reach by then are
+    paired, so a prediction doesn't visit every sprite.
+
+    Like discrete physics resolves each pair once per frame, a pair of
+    asteroids collides at most once per advance. In a pile of overlapping
+    asteroids pushing one pair apart makes others overlap, their next
+    contact waits for the following advance instead of looping at one instant.
+    """
+
+    def __init__(self, asteroids, bullets, window_mode):
+        self.asteroids = asteroids
+        self.bullets = bullets
+        self.groups = (asteroids, bullets)
+        self.window_mode = window_mode
+        self.game_mode = None
+        self.time = 0.0
+        self.queue = []
+        self.versions = {}
+        # (time, x, y, vx, vy, speed) of the origin of every sprite since its last prediction
+        self.motion = {}
+        # Origins of the last predictions, never more than HORIZON old
+        self.grids = {asteroids: Grid(), bullets: Grid()}
+        self.counter = itertools.count()
+        self.predictions = 0
+        # Pairs collided during this advance, and their contacts put off to the next one
+        self.resolved = set()
+        self.deferred = []
+        # Size of the queue that triggers dropping stale events
+        self.compact_size = COMPACT_SIZE
+
+    def velocity(self, sprite):
+        if sprite.moving(self.game_mode):
+            return sprite.velocity
+        return Vec(0, 0)
+
+    def push(self, time, kind, a, b=None):
+        versions = (self.versions[a], self.versions.get(b) if kind in PAIR_EVENTS else None)
+        heapq.heappush(self.queue, Event(time, next(self.counter), kind, a, b, versions))
+
+    def stale(self, event):
+        a, b = event.a, event.b
+        if not a.alive() or self.versions.get(a) != event.versions[0]:
+            return True
+        if event.kind in PAIR_EVENTS and (not b.alive() or self.versions.get(b) != event.versions[1]):
+            return True
+        return False
+
+    def where(self, sprite):
+        """
+        Return the origin and velocity of sprite at self.time as float tuples.
+        """
+        start, x, y, vx, vy, _ = self.motion[sprite]
+        elapsed = self.time - start
+        return (x + vx*elapsed, y + vy*elapsed), (vx, vy)
+
+    def catch_up(self, sprite):
+        """
+        Move sprite to where it is at self.time.
+        """
+        start = self.motion[sprite][0]
+        if start == self.time:
+            return
+        origin, velocity = self.where(sprite)
+        sprite.origin = origin
+        if sprite in self.bullets:
+            sprite.ttl -= self.time - start
+        self.motion[sprite] = (self.time, *origin, *velocity, self.motion[sprite][5])
+
+    def predict(self, sprite):
+        """
+        Invalidate all events of sprite and schedule new ones.
+        The sprite has to be at its position at self.time.
+        """
+        self.versions[sprite] = self.versions.get(sprite, 0) + 1
+        velocity = self.velocity(sprite)
+        vx, vy = velocity.values
+        x, y, speed = sprite.x + sprite.radius, sprite.y + sprite.radius, math.sqrt(vx*vx + vy*vy)
+        self.motion[sprite] = (self.time, x, y, vx, vy, speed)
+        group = self.bullets if sprite in self.bullets else self.asteroids
+        self.grids[group].move(sprite, x, y, speed)
+
+        wall = wall_time(sprite, velocity, self.window_mode)
+        if wall is not None and wall[0] <= HORIZON:
+            self.push(self.time + wall[0], 'wall', sprite, wall[1])
+        else:
+            self.push(self.time + HORIZON, 'horizon', sprite)
+
+        if sprite in self.bullets:
+            self.push(self.time + max(sprite.ttl, 0.0), 'expire', sprite)
+            others, kind = self.asteroids, 'hit'
+        else:
+            others, kind = self.asteroids, 'collide'
+            self.pairs(sprite, self.bullets, 'hit', swap=True)
+
+        self.pairs(sprite, others, kind)
+
+    def pairs(self, sprite, others, kind, swap=False):
+        now = self.time
+        motion = self.motion
+        _, x, y, vx, vy, speed = motion[sprite]
+        grid = self.grids[others]
+        # Others have moved up to HORIZON since they were put in the grid, and move on as long
+        distance = sprite.radius + grid.max_radius + (speed + 2 * grid.max_speed) * HORIZON
+        for other in grid.near(x, y, distance):
+            if other is sprite or other not in motion:
+                continue
+            start, ox, oy, ovx, ovy, other_speed = motion[other]
+            elapsed = now - start
+            ox, oy = ox + ovx*elapsed, oy + ovy*elapsed
+            # Pairs that can't close the gap within the horizon are predicted again later
+            reach = sprite.radius + other.radius + (speed + other_speed) * HORIZON
+            if (ox - x)*(ox - x) + (oy - y)*(oy - y) > reach*reach:
+                continue
+            if swap:
+                self.predict_pair(other, (ox, oy), (ovx, ovy), sprite, (x, y), (vx, vy), kind)
+            else:
+                self.predict_pair(sprite, (x, y), (vx, vy), other, (ox, oy), (ovx, ovy), kind)
+
+    def predict_pair(self, a, origin_a, velocity_a, b, origin_b, velocity_b, kind):
+        self.predictions += 1
+        t = time_of_impact(
+            origin_a, velocity_a,
+            origin_b, velocity_b,
+            a.radius + b.radius,
+            # A bullet inside an asteroid hits it even when flying outwards
+            contact=kind == 'hit',
+        )
+        if t is None or t > HORIZON:
+            return
+        if kind == 'collide' and frozenset((a, b)) in self.resolved:
+            self.deferred.append((a, b))
+            return
+        self.push(self.time + t, kind, a, b)
+
+    def sync(self):
+        """
+        Schedule sprites added to the groups since the last call and forget dead ones.
+        """
+        for sprite in [s for s in self.versions if not s.alive()]:
+            del self.versions[sprite]
+            del self.motion[sprite]
+            for grid in self.grids.values():
+                grid.remove(sprite)
+        for group in self.groups:
+            for sprite in group:
+                if sprite not in self.versions:
+                    self.predict(sprite)
+
+    def rebuild(self):
+        self.queue = []
+        self.versions = {}
+        self.motion = {}
+        self.grids = {self.asteroids: Grid(), self.bullets: Grid()}
+        self.deferred = []
+        self.sync()
+
+    def undefer(self):
+        """
+        Predict the contacts put off during the last advance again.
+        """
+        deferred, self.deferred = self.deferred, []
+        for a, b in deferred:
+            if a in self.versions and b in self.versions:
+                self.predict_pair(a, *self.where(a), b, *self.where(b), 'collide')
+
+    def compact(self):
+        """
+        Drop stale events once they make up most of the queue.
+        """
+        if len(self.queue) < self.compact_size:
+            return
+        self.queue = [event for event in self.queue if not self.stale(event)]
+        heapq.heapify(self.queue)
+        self.compact_size = max(2 * len(self.queue), COMPACT_SIZE)
+
+    def advance(self, dt, game_mode):
+        """
+        Simulate dt milliseconds, resolving every event on the way.
+        Returns the number of asteroids hit by bullets.
+        """
+        if game_mode != self.game_mode:
+            self.game_mode = game_mode
+            self.rebuild()
+        else:
+            self.sync()
+        self.resolved.clear()
+        self.undefer()
+        self.compact()
+
+        reward = 0
+        end = self.time + dt
+        while self.queue and self.queue[0].time <= end:
+            event = heapq.heappop(self.queue)
+            if self.stale(event):
+                continue
+            self.time = max(self.time, event.time)
+            a, b = event.a, event.b
+            self.catch_up(a)
+            if event.kind in PAIR_EVENTS:
+                self.catch_up(b)
+
+            if event.kind == 'wall':
+                wrap(a, b, self.velocity(a), self.window_mode)
+                self.predict(a)
+            elif event.kind == 'horizon':
+                self.predict(a)
+            elif event.kind == 'collide':
+                a.collide(b)
+                self.resolved.add(frozenset((a, b)))
+                self.predict(a)
+                self.predict(b)
+            elif event.kind == 'hit':
+                a.collide(b, self.asteroids)
+                reward += 1
+                self.sync()
+            elif event.kind == 'expire':
+                a.kill()
+
+        self.time = end
+        for sprite in self.versions:
+            self.catch_up(sprite)
+        return reward
+
+
+def swept_time(a, b, dt, game_mode):
+    """
+    Return the time within the next dt when two sprites first touch,
+    0 if they already overlap, or None if they stay apart for the whole step.
+    """
+    # Floats instead of Vectors, this runs for every pair on every frame
+    ax, ay = a.x + a.radius, a.y + a.radius
+    bx, by = b.x + b.radius, b.y + b.radius
+    distance = a.radius + b.radius
+    dx, dy = ax - bx, ay - by
+    gap = dx*dx + dy*dy
+    if gap <= distance*distance:
+        return 0.0
+    va = a.velocity.values if a.moving(game_mode) else (0, 0)
+    vb = b.velocity.values if b.moving(game_mode) else (0, 0)
+    # Sprites further apart than they can close within dt stay apart
+    dvx, dvy = va[0] - vb[0], va[1] - vb[1]
+    reach = distance + math.sqrt(dvx*dvx + dvy*dvy) * dt
+    if gap > reach*reach:
+        return None
+    t = time_of_impact((ax, ay), va, (bx, by), vb, distance)
+    if t is None or t > dt:
+        return None
+    return t
+
+
+def collide_at(a, b, t, game_mode):
+    """
+    Resolve an asteroid collision happening t into the step.
+
+    Both asteroids are moved to the point of impact, collided and then moved
+    back along their new velocities, so that the regular move over the whole
+    step lands them where they would be after bouncing at t.
+    """
+    if not t:
+        a.collide(b)
+        return
+    for sprite in (a, b):
+        if sprite.moving(game_mode):
+            sprite.position += sprite.velocity * t
+    a.collide(b)
+    for sprite in (a, b):
+        if sprite.moving(game_mode):
+            sprite.position -= sprite.velocity * t
+
+
+def play_dense(physics, n_asteroids, frames):
+    """
+    Play a headless game starting from n_asteroids overlapping asteroids,
+    return the mean time of a frame in seconds.
+    """
+    import asteroids
+
+    game = asteroids.Game(640*2, 480*2, physics=physics, dt=1000 / 60, headless=True, render=False)
+    game.seed = 0
+    game.reset()
+    # God mode keeps the game from resetting on death
+    game.mode = asteroids.pygame.K_2
+    game.asteroids.add(asteroids.Asteroid.random(game.width, game.height) for _ in range(n_asteroids))
+    start = time.perf_counter()
+    for _ in range(frames):
+        game.run_once()
+    return (time.perf_counter() - start) / frames
+
+
+def hit_inside(physics):
+    """
+    Return the reward of a bullet that starts inside an asteroid and flies outwards.
+    """
+    import asteroids
+
+    game = asteroids.Game(640*2, 480*2, physics=physics, dt=1000 / 60, headless=True, render=False)
+    game.seed = 0
+    game.reset()
+    game.mode = asteroids.pygame.K_2
+    game.asteroids.empty()
+    asteroid = asteroids.Asteroid(pos=[0, 0], velocity=[0, 0], radius=80)
+    asteroid.origin = (400, 400)
+    bullet = asteroids.Bullet(pos=[0, 0], velocity=Vec(1, 0))
+    bullet.origin = (420, 400)
+    game.asteroids.add(asteroid)
+    game.bullets.add(bullet)
+    reward, _, _ = game.run_once()
+    return reward
+
+
+def player_crash(physics, scale):
+    """
+    Return whether a player flying at an asteroid dies within a second of steps scale times the usual dt.
+    """
+    import asteroids
+
+    game = asteroids.Game(640*2, 480*2, physics=physics, dt=1000 / 60 * scale, headless=True, render=False)
+    game.seed = 0
+    game.reset()
+    game.asteroids.empty()
+    game.player.invincible = 0
+    game.player.velocity = Vec(0.69, 0)
+    asteroid = asteroids.Asteroid(pos=[0, 0], velocity=[0, 0], radius=17.5)
+    # At 10 times dt the player jumps over the asteroid between two steps
+    asteroid.origin = (game.width / 2 + 200, game.height / 2)
+    game.asteroids.add(asteroid)
+    for _ in range(math.ceil(60 / scale)):
+        if game.run_once()[1]:
+            return True
+    return False
+
+
+def bullet_through_pair(physics, scale):
+    """
+    Return the score of a bullet flying at two asteroids in a row, with steps scale times the usual dt.
+    """
+    import asteroids
+
+    game = asteroids.Game(640*2, 480*2, physics=physics, dt=1000 / 60 * scale, headless=True, render=False)
+    game.seed = 0
+    game.reset()
+    game.mode = asteroids.pygame.K_2
+    game.asteroids.empty()
+    # Small enough not to split, so the score only counts the hits
+    for x in (500, 560):
+        asteroid = asteroids.Asteroid(pos=[0, 0], velocity=[0, 0], radius=17.5)
+        asteroid.origin = (x, 400)
+        game.asteroids.add(asteroid)
+    bullet = asteroids.Bullet(pos=[0, 0], velocity=Vec(1, 0))
+    bullet.origin = (400, 400)
+    game.bullets.add(bullet)
+    for _ in range(math.ceil(60 / scale)):
+        game.run_once()
+    return game.player.score
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the event physics on overlapping sprites.")
+    parser.add_argument('--asteroids', type=int, default=100, help="Asteroids of the dense start")
+    parser.add_argument('--frames', type=int, default=60)
+    parser.add_argument('--max-ratio', type=float, default=8.0,
+                        help="Times slower than discrete physics event physics may play the dense start")
+    args = parser.parse_args()
+
+    import asteroids
+
+    for physics in sorted(asteroids.Game.physics_modes):
+        reward = hit_inside(physics)
+        if reward != 1:
+            raise SystemExit('%s physics: a bullet inside an asteroid scored %s' % (physics, reward))
+    print('A bullet inside an asteroid hits it in every physics mode')
+
+    for physics in sorted(asteroids.Game.physics_modes - {'discrete'}):
+        for scale in (1, 4, 10):
+            if not player_crash(physics, scale):
+                raise SystemExit('%s physics: the player flew through an asteroid at %s times dt' % (physics, scale))
+    print('The player hits an asteroid at up to 10 times dt in swept and event physics')
+
+    for physics in sorted(asteroids.Game.physics_modes - {'discrete'}):
+        for scale in (1, 4, 10):
+            score = bullet_through_pair(physics, scale)
+            if score != 1:
+                raise SystemExit('%s physics: a bullet through two asteroids scored %s at %s times dt' % (
+                    physics, score, scale))
+    print('A bullet scores once on the first of two asteroids at up to 10 times dt in swept and event physics')
+
+    # Compared with discrete physics, which resolves every overlapping pair once per frame
+    discrete = play_dense('discrete', args.asteroids, args.frames)
+    event = play_dense('event', args.asteroids, args.frames)
+    print('Dense start of %s asteroids: %.4f s per frame in event physics, %.4f s in discrete physics' % (
+        args.asteroids, event, discrete))
+    if event > args.max_ratio * discrete:
+        raise SystemExit('Dense start: event physics is %.1f times slower than discrete physics' % (event / discrete))
+
+
+if __name__ == "__main__":
+    main()
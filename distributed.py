@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Distributed DQN rollouts over TCP.
+
+The learner runs a parameter server. Rollout workers pull the latest
+weights from it and push the frames they play back in chunks. Every message
+is a json header followed by raw arrays, zlib compressed and length
+prefixed, so nothing but numbers is deserialized from the network.
+
+On one machine:
+    python distributed.py local --workers 4
+
+Across machines:
+    python distributed.py learner --host 0.0.0.0 --port 5555
+    python distributed.py worker --host learner.local --port 5555
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import queue
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+import asteroids
+import qnet_learn
+from metrics import MetricsLogger
+
+
+PORT = 5555
+# Steps a worker collects before pushing them, episode ends are pushed right away
+CHUNK_STEPS = 256
+# Steps between a worker's checks for new weights
+PULL_EVERY = 1000
+# Gradient updates between published weight versions
+PUBLISH_EVERY = 100
+COMPRESS_LEVEL = 1
+
+LENGTH = struct.Struct('>I')
+
+
+def encode(header, arrays=None):
+    """
+    Return a message of a json header and a dict of numpy arrays, ready to send.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in (arrays or {}).items()}
+    header = dict(header, arrays=[(name, array.dtype.str, array.shape) for name, array in arrays.items()])
+    head = json.dumps(header).encode()
+    body = b''.join([LENGTH.pack(len(head)), head] + [array.tobytes() for array in arrays.values()])
+    payload = zlib.compress(body, COMPRESS_LEVEL)
+    return LENGTH.pack(len(payload)) + payload
+
+
+def decode(payload):
+    """
+    Return (header, arrays) of a message without its length prefix.
+    """
+    body = zlib.decompress(payload)
+    (length,) = LENGTH.unpack_from(body)
+    offset = LENGTH.size + length
+    header = json.loads(body[LENGTH.size:offset])
+    arrays = {}
+    for name, dtype, shape in header.pop('arrays'):
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(body, dtype=dtype, count=count, offset=offset).reshape(shape)
+        offset += count * dtype.itemsize
+    return header, arrays
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        part = sock.recv(size - len(data))
+        if not part:
+            raise ConnectionError('Connection closed')
+        data += part
+    return bytes(data)
+
+
+def recv(sock):
+    (length,) = LENGTH.unpack(recv_exactly(sock, LENGTH.size))
+    return decode(recv_exactly(sock, length))
+
+
+def send(sock, header, arrays=None):
+    sock.sendall(encode(header, arrays))
+
+
+class Handler(socketserver.BaseRequestHandler):
+    """
+    Serve one worker connection.
+
+    Pushed steps are collected per connection and only complete episodes
+    are handed to the learner. This keeps each episode in consecutive
+    replay memory slots, as FrameReplayMemory expects.
+    """
+
+    def handle(self):
+        server = self.server
+        pending = []
+        while True:
+            try:
+                header, arrays = recv(self.request)
+            except (ConnectionError, OSError):
+                break
+
+            if header['type'] == 'pull':
+                version, message = server.snapshot
+                if version > header['version']:
+                    self.request.sendall(message)
+                else:
+                    send(self.request, dict(type='weights', version=version))
+
+            elif header['type'] == 'push':
+                dones = arrays['dones']
+                start = 0
+                for end in np.flatnonzero(dones) + 1:
+                    pending.append({name: array[start:end] for name, array in arrays.items()})
+                    server.episodes.put((header['worker'], header['version'], pending))
+                    pending = []
+                    start = end
+                if start < len(dones):
+                    pending.append({name: array[start:] for name, array in arrays.items()})
+                send(self.request, dict(type='ok'))
+
+
+class ParameterServer(socketserver.ThreadingTCPServer):
+    """
+    Hand out versioned weights and collect the episodes of workers.
+
+    publish() encodes the weights once, every worker asking for a newer
+    version is sent the same compressed message.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, Handler)
+        self.episodes = queue.Queue()
+        self.snapshot = (0, None)
+
+    def publish(self, version, state_dict, epsilon):
+        arrays = {name: tensor.detach().cpu().contiguous().numpy() for name, tensor in state_dict.items()}
+        self.snapshot = (version, encode(dict(type='weights', version=version, epsilon=epsilon), arrays))
+
+
+def learn(server, updates, metrics, **options):
+    """
+    Train on the episodes pushed by workers for the given number of gradient updates.
+    """
+    learner = qnet_learn.Learner(len(asteroids.ACTIONS), **options)
+    version = 1
+    server.publish(version, learner.policy_net.state_dict(), learner.epsilon())
+    n_episodes = 0
+    n_updates = 0
+    start = time.perf_counter()
+    while n_updates < updates:
+        try:
+            while True:
+                # Wait for episodes only while there is nothing to learn from
+                waiting = len(learner.memory) < learner.batch_size
+                worker, worker_version, chunks = server.episodes.get(block=waiting, timeout=1)
+                for chunk in chunks:
+                    for frame, action, reward, done in zip(chunk['frames'], chunk['actions'], chunk['rewards'], chunk['dones']):
+                        learner.memory.push(frame, action, reward, done)
+                length = sum(len(chunk['dones']) for chunk in chunks)
+                # Epsilon follows the steps played by all workers
+                learner.steps_done += length
+                metrics.log(
+                    episode=n_episodes,
+                    worker=worker,
+                    reward=float(sum(chunk['rewards'].sum() for chunk in chunks)),
+                    length=length,
+                    version_lag=version - worker_version,
+                    updates_per_second=n_updates / (time.perf_counter() - start),
+                )
+                n_episodes += 1
+                if n_episodes % qnet_learn.TARGET_UPDATE == 0:
+                    learner.update_target()
+        except queue.Empty:
+            pass
+
+        if learner.optimize_model() is not None:
+            n_updates += 1
+            if n_updates % PUBLISH_EVERY == 0:
+                version += 1
+                server.publish(version, learner.policy_net.state_dict(), learner.epsilon())
+    return learner
+
+
+def run_worker(host, port, worker=0, chunk_steps=CHUNK_STEPS, pull_every=PULL_EVERY):
+    """
+    Play epsilon greedy with the latest weights of the server until it goes away.
+    """
+    import torch
+
+    torch.set_num_threads(1)
+    env = qnet_learn.AsteroidsEnv()
+    net = qnet_learn.DQN(env.frame_size, env.frame_size, env.n_actions, dueling=qnet_learn.DUELING)
+    net.eval()
+    version = 0
+    epsilon = 1.0
+    random.seed(worker)
+
+    with socket.create_connection((host, port)) as sock:
+        def pull():
+            nonlocal version, epsilon
+            send(sock, dict(type='pull', version=version))
+            header, arrays = recv(sock)
+            if arrays:
+                net.load_state_dict({name: torch.from_numpy(array.copy()) for name, array in arrays.items()})
+                version = header['version']
+                epsilon = header['epsilon']
+
+        def push(steps):
+            frames, actions, rewards, dones = zip(*steps)
+            send(sock, dict(type='push', worker=worker, version=version), dict(
+                frames=np.stack(frames),
+                actions=np.array(actions, dtype=np.int64),
+                rewards=np.array(rewards, dtype=np.float32),
+                dones=np.array(dones, dtype=bool),
+            ))
+            recv(sock)
+
+        try:
+            pull()
+            steps = []
+            frame = env.reset()
+            for t in itertools.count(1):
+                if random.random() > epsilon:
+                    with torch.inference_mode():
+                        action = int(net(env.state()).argmax(1))
+                else:
+                    action = random.randrange(env.n_actions)
+                next_frame, reward, done = env.step(action)
+                steps.append((frame, action, reward, done))
+                frame = next_frame
+                if done or len(steps) >= chunk_steps:
+                    push(steps)
+                    steps = []
+                if done:
+                    frame = env.reset()
+                if t % pull_every == 0:
+                    pull()
+        except (ConnectionError, OSError):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed DQN rollouts for asteroids.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name in ('learner', 'worker', 'local'):
+        command = commands.add_parser(name)
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--port', type=int, default=PORT if name != 'local' else 0)
+        if name == 'worker':
+            command.add_argument('--worker', type=int, default=0, help="Id of the worker, also its random seed")
+        else:
+            command.add_argument('--updates', type=int, default=100000, help="Gradient updates before stopping")
+            command.add_argument('--threads', type=int, default=qnet_learn.INTRA_OP_THREADS)
+            command.add_argument('--export', metavar='FILE', help="Save the trained policy for asteroids.py --agent")
+        if name == 'local':
+            command.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        run_worker(args.host, args.port, args.worker)
+        return
+
+    qnet_learn.configure_threads(args.threads)
+    server = ParameterServer((args.host, args.port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    print('Parameter server on %s:%s' % (host, port))
+
+    workers = []
+    if args.command == 'local':
+        # Spawned workers don't inherit the thread pools of torch
+        context = multiprocessing.get_context('spawn')
+        workers = [
+            context.Process(target=run_worker, args=(host, port, i), daemon=True)
+            for i in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+
+    metrics = MetricsLogger(qnet_learn.METRICS_PATH)
+    learner = learn(server, args.updates, metrics)
+    server.shutdown()
+    server.server_close()
+    for worker in workers:
+        worker.terminate()
+    metrics.close()
+    if args.export:
+        learner.export(args.export)
+    print('Complete, mean reward of the last 100 episodes %.2f' % metrics.mean('reward'))
+
+
+if __name__ == "__main__":
+    main()
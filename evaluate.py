@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Evaluate agents on a fixed set of seeded games.
+
+Each seed is one game played until the player dies or the step limit is
+reached, spread over a process pool. Results are appended to a cache
+keyed by the hash of the agent file, asteroids.ENV_VERSION and the
+evaluation settings, so an unchanged agent is never played again:
+
+    python evaluate.py whiskers.npz agent.pt --seeds 100 --workers 8
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+import agent as agents
+import asteroids
+from metrics import read
+
+
+CACHE_PATH = 'evaluations.jsonl'
+WIDTH, HEIGHT = 640*2, 480*2
+PERCENTILES = [5, 25, 50, 75, 95]
+
+# Agent and game of the worker process
+_agent = None
+_game = None
+
+
+def init_worker(path, physics, dt):
+    global _agent, _game
+    _agent = agents.load(path)
+    _game = asteroids.Game(WIDTH, HEIGHT, physics=physics, dt=dt, headless=True, render=_agent.needs_frames)
+
+
+def play(seed, steps):
+    """
+    Play the game of seed with the agent of the worker, return (score, seconds survived).
+    """
+    game = _game
+    game.seed = seed
+    # The game is reused for every seed of the worker, reset() clears all of its per-game state
+    game.reset()
+    if game.render:
+        # Frame agents look at the screen before the first step, drawn as in qnet_learn.AsteroidsEnv
+        game.draw()
+        game.whiskers()
+    score = 0
+    for step in range(1, steps + 1):
+        # The game resets when the player dies, so the score is summed from the rewards
+        reward, die, _ = game.run_once(_agent.act(game))
+        score += reward
+        if die:
+            break
+    return score, step * game.dt / 1000
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(path, seeds, steps, physics, dt):
+    settings = dict(seeds=list(seeds), steps=steps, physics=physics, dt=dt, env_version=asteroids.ENV_VERSION)
+    return hashlib.sha256(json.dumps([file_hash(path), settings], sort_keys=True).encode()).hexdigest()[:16]
+
+
+def evaluate(path, seeds, steps, physics, dt, workers):
+    """
+    Return (scores, seconds) arrays with one entry per seed.
+    """
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, initializer=init_worker, initargs=(path, physics, dt)) as pool:
+        results = pool.starmap(play, [(seed, steps) for seed in seeds], chunksize=1)
+    scores, seconds = zip(*results)
+    return np.array(scores), np.array(seconds)
+
+
+def summary(values):
+    values = np.asarray(values, dtype=float)
+    return dict(
+        mean=values.mean(),
+        std=values.std(),
+        min=values.min(),
+        max=values.max(),
+        **{'p%s' % p: v for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+    )
+
+
+def report(path, scores, seconds, cached):
+    print('%s%s, %s games' % (path, ' (cached)' if cached else '', len(scores)))
+    for name, values in (('score', scores), ('survived s', seconds)):
+        print('  %-10s ' % name + '  '.join('%s %.2f' % item for item in summary(values).items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate agents on seeded asteroids games.")
+    parser.add_argument('agents', nargs='+', help="Agent files, see agent.py")
+    parser.add_argument('--seeds', type=int, default=100, help="Number of seeded games")
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('--steps', type=int, default=3600, help="Maximum frames per game")
+    parser.add_argument('--physics', choices=sorted(asteroids.Game.physics_modes), default='discrete')
+    parser.add_argument('--dt', type=float, default=1000 / 60)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--cache', default=CACHE_PATH)
+    args = parser.parse_args()
+
+    seeds = range(args.first_seed, args.first_seed + args.seeds)
+    rows, _ = read(args.cache)
+    cache = {row['key']: row for row in rows}
+    for path in args.agents:
+        key = cache_key(path, seeds, args.steps, args.physics, args.dt)
+        row = cache.get(key)
+        cached = row is not None
+        if not cached:
+            scores, seconds = evaluate(path, seeds, args.steps, args.physics, args.dt, args.workers)
+            row = dict(key=key, agent=path, scores=scores.tolist(), seconds=seconds.tolist())
+            with open(args.cache, 'a') as f:
+                f.write(json.dumps(row) + '\n')
+            cache[key] = row
+        report(path, row['scores'], row['seconds'], cached)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Neuroevolution of whisker policies.
+
+Every generation the population is split into chunks that are evaluated on
+headless games in a process pool. Each worker plays its whole chunk in
+lockstep, so the policies of the chunk are evaluated with one batched forward
+pass per frame. All policies play the same seeded start states, which keeps
+the fitness comparable between them.
+
+    python evolution_learn.py --population 256 --generations 100 --checkpoints checkpoints/
+"""
+import argparse
+import glob
+import math
+import multiprocessing
+import os
+
+import numpy as np
+
+import asteroids
+import policy
+
+
+WIDTH, HEIGHT = 640*2, 480*2
+
+# Games of the worker process, reused between chunks
+_games = []
+
+
+def worker_games(n, physics, dt):
+    while len(_games) < n:
+        _games.append(asteroids.Game(WIDTH, HEIGHT, physics=physics, dt=dt, headless=True, render=False))
+    return _games[:n]
+
+
+def evaluate(chunk, seeds, steps, physics, dt):
+    """
+    Return the fitness of every policy in chunk, averaged over the seeded games.
+    Fitness is the score plus one point for every second survived.
+    """
+    fitness = np.zeros(len(chunk))
+    games = worker_games(len(chunk), physics, dt)
+    for seed in seeds:
+        for game in games:
+            game.seed = seed
+            game.reset()
+
+        alive = np.ones(len(chunk), dtype=bool)
+        score = np.zeros(len(chunk))
+        survived = np.zeros(len(chunk))
+        for _ in range(steps):
+            indices = np.flatnonzero(alive)
+            if not len(indices):
+                break
+            x = np.stack([policy.observe(games[i].observation) for i in indices])
+            actions = policy.act(policy.unflatten(chunk[indices]), x)
+            for i, action in zip(indices, actions):
+                reward, die, _ = games[i].run_once(int(action))
+                score[i] += reward
+                survived[i] += games[i].dt
+                if die:
+                    alive[i] = False
+        fitness += score + survived / 1000
+
+    return fitness / len(seeds)
+
+
+def _evaluate(args):
+    return evaluate(*args)
+
+
+def next_generation(population, fitness, rng, elite, mutation):
+    """
+    Keep the elite unchanged and breed the rest from the top half
+    with uniform crossover and gaussian mutation.
+    """
+    order = np.argsort(-fitness)
+    parents = population[order[:max(len(population) // 2, 2)]]
+    children = population[order[:elite]].copy()
+
+    n_children = len(population) - elite
+    mothers = parents[rng.integers(len(parents), size=n_children)]
+    fathers = parents[rng.integers(len(parents), size=n_children)]
+    mask = rng.random(mothers.shape) < 0.5
+    offspring = np.where(mask, mothers, fathers)
+    offspring += rng.standard_normal(offspring.shape).astype(np.float32) * mutation
+    return np.concatenate([children, offspring]).astype(np.float32)
+
+
+def checkpoint_path(directory, generation):
+    return os.path.join(directory, 'generation_%05d.npz' % generation)
+
+
+def load_checkpoint(directory):
+    """
+    Return (generation, population, fitness) of the latest checkpoint in directory or None.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, 'generation_*.npz')))
+    if not paths:
+        return None
+    data = np.load(paths[-1])
+    return int(data['generation']), data['population'], data['fitness']
+
+
+def save_checkpoint(directory, generation, population, fitness):
+    best = np.argmax(fitness)
+    np.savez(
+        checkpoint_path(directory, generation),
+        generation=generation,
+        population=population,
+        fitness=fitness,
+        best=population[best],
+        layers=np.array(policy.LAYERS),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evolve whisker policies for asteroids.")
+    parser.add_argument('--population', type=int, default=256)
+    parser.add_argument('--generations', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seeds', type=int, nargs='+', default=[2, 3, 4], help="Game seeds every policy plays")
+    parser.add_argument('--steps', type=int, default=3600, help="Maximum frames per game")
+    parser.add_argument('--physics', choices=sorted(asteroids.Game.physics_modes), default='swept')
+    parser.add_argument('--dt', type=float, default=1000 / 60)
+    parser.add_argument('--elite', type=int, default=4)
+    parser.add_argument('--mutation', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the evolution itself")
+    parser.add_argument('--checkpoints', default='checkpoints', help="Directory for generation checkpoints")
+    args = parser.parse_args()
+
+    os.makedirs(args.checkpoints, exist_ok=True)
+    checkpoint = load_checkpoint(args.checkpoints)
+    if checkpoint is None:
+        start = 0
+        population = policy.random_population(args.population, np.random.default_rng(args.seed))
+    else:
+        generation, population, fitness = checkpoint
+        start = generation + 1
+        rng = np.random.default_rng([args.seed, generation])
+        population = next_generation(population, fitness, rng, args.elite, args.mutation)
+        print('Resuming after generation %s' % generation)
+
+    # A few chunks per worker evens out games that end early
+    n_chunks = min(len(population), args.workers * 4)
+    chunk_size = math.ceil(len(population) / n_chunks)
+
+    with multiprocessing.Pool(args.workers) as pool:
+        for generation in range(start, start + args.generations):
+            chunks = [population[i:i + chunk_size] for i in range(0, len(population), chunk_size)]
+            fitness = np.concatenate(pool.map(_evaluate, [
+                (chunk, args.seeds, args.steps, args.physics, args.dt) for chunk in chunks
+            ]))
+            save_checkpoint(args.checkpoints, generation, population, fitness)
+            print('Generation %s: best %.2f, mean %.2f' % (generation, fitness.max(), fitness.mean()))
+
+            rng = np.random.default_rng([args.seed, generation])
+            population = next_generation(population, fitness, rng, args.elite, args.mutation)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Physics kernels of asteroids.py on plain floats.
+
+The kernels are compiled with Numba when it is installed and stay plain
+Python otherwise. Both backends do the same floating point operations in
+the same order, squares included are written as products because Numba
+turns x**2 into x*x, so they play bit for bit the same games.
+The whisker kernel works on all rays and asteroids at once, as loops
+under Numba and broadcast NumPy without it.
+
+Setting ASTEROIDS_KERNELS=python skips Numba. Check that both backends
+play the same game with:
+
+    python kernels.py --frames 2000
+"""
+import argparse
+import math
+import os
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def wrap(x, y, width, height, max_width, max_height):
+    """
+    Return the position after leaving the window on one side and entering on the other.
+    """
+    if x > max_width - (width / 2):
+        x = -(width / 2)
+    elif x < -(width / 2):
+        x = max_width - (width / 2)
+
+    if y > max_height - (height / 2):
+        y = -(height / 2)
+    elif y < -(height / 2):
+        y = max_height - (height / 2)
+    return x, y
+
+
+def intersect(start_x, start_y, stop_x, stop_y, center_x, center_y, radius):
+    """
+    Distance from start along the ray towards stop to the circle, 0 when the ray misses it.
+    """
+    dx, dy = stop_x - start_x, stop_y - start_y
+    norm = math.sqrt(dx * dx + dy * dy)
+    dx, dy = dx / norm, dy / norm
+    fx, fy = start_x - center_x, start_y - center_y
+
+    a = dx * dx + dy * dy
+    b = 2 * (fx * dx + fy * dy)
+    c = (fx * fx + fy * fy) - radius * radius
+    discriminant = b * b - 4 * a * c
+    if discriminant < 0:
+        return 0.0
+
+    discriminant = math.sqrt(discriminant)
+    t1 = (-b - discriminant) / (2 * a)
+    t2 = (-b + discriminant) / (2 * a)
+    if t1 >= 0:
+        return t1
+    if t2 >= 0:
+        return t2
+    return 0.0
+
+
+def collide(x1, y1, vx1, vy1, radius1, mass1, x2, y2, vx2, vy2, radius2, mass2):
+    """
+    Elastic collision of two circles given by their origins.
+    Returns (shift_x, shift_y, vx1, vy1, vx2, vy2), the first circle moves
+    by shift and the second by -shift to separate them.
+    """
+    dx, dy = x1 - x2, y1 - y2
+    norm = math.sqrt(dx * dx + dy * dy)
+    if norm:
+        nx, ny = dx / norm, dy / norm
+    else:
+        # Like Vector.normalize, circles at the same origin get no normal
+        nx, ny = dx, dy
+    overlap = (radius1 + radius2) - norm
+    tx, ty = -ny, nx
+
+    v1n = nx * vx1 + ny * vy1
+    v2n = nx * vx2 + ny * vy2
+    v1t = tx * vx1 + ty * vy1
+    v2t = tx * vx2 + ty * vy2
+
+    # New velocity scalars on the collision normal, the tangent velocity stays the same
+    total = mass1 + mass2
+    normal_speed1 = v1n * (mass1 - mass2) + 2 * mass2 * v2n
+    normal_speed2 = v2n * (mass2 - mass1) + 2 * mass1 * v1n
+    return (
+        nx * overlap / 2,
+        ny * overlap / 2,
+        nx * normal_speed1 / total + v1t * tx,
+        ny * normal_speed1 / total + v1t * ty,
+        nx * normal_speed2 / total + v2t * tx,
+        ny * normal_speed2 / total + v2t * ty,
+    )
+
+
+def whisker_distances_numpy(start_x, start_y, stops, centers, radii, size):
+    """
+    Distance along each ray from start towards the rows of stops to the nearest circle,
+    size when no circle is closer.
+    """
+    distances = np.full(len(stops), float(size))
+    if not len(centers):
+        return distances
+    dx, dy = stops[:, 0] - start_x, stops[:, 1] - start_y
+    norm = np.sqrt(dx * dx + dy * dy)
+    dx, dy = (dx / norm)[:, None], (dy / norm)[:, None]
+    fx, fy = start_x - centers[:, 0], start_y - centers[:, 1]
+
+    a = dx * dx + dy * dy
+    b = 2 * (fx * dx + fy * dy)
+    c = (fx * fx + fy * fy) - radii * radii
+    discriminant = b * b - 4 * a * c
+    hit = discriminant >= 0
+    discriminant = np.sqrt(np.where(hit, discriminant, 0))
+    t1 = (-b - discriminant) / (2 * a)
+    t2 = (-b + discriminant) / (2 * a)
+    t = np.where(t1 >= 0, t1, np.where(t2 >= 0, t2, 0))
+    t = np.where(hit & (t != 0) & (t < size), t, size)
+    return np.minimum(distances, t.min(axis=1))
+
+
+def whisker_distances_loops(start_x, start_y, stops, centers, radii, size):
+    distances = np.full(len(stops), float(size))
+    for i in range(len(stops)):
+        for j in range(len(centers)):
+            t = _intersect(start_x, start_y, stops[i, 0], stops[i, 1], centers[j, 0], centers[j, 1], radii[j])
+            if t != 0 and t < distances[i]:
+                distances[i] = t
+    return distances
+
+
+_python = dict(
+    wrap=wrap,
+    intersect=intersect,
+    collide=collide,
+    whisker_distances=whisker_distances_numpy,
+)
+
+_compiled = {}
+if numba is not None:
+    # Compiled on the first call, cached on disk for later processes
+    # whisker_distances_loops calls this global, numba binds it when compiling
+    _intersect = numba.njit(cache=True)(intersect)
+    _compiled = dict(
+        wrap=numba.njit(cache=True)(wrap),
+        intersect=_intersect,
+        collide=numba.njit(cache=True)(collide),
+        whisker_distances=numba.njit(cache=True)(whisker_distances_loops),
+    )
+
+
+def use(backend):
+    """
+    Switch the kernels of this module to 'numba' or 'python'.
+    """
+    global BACKEND
+    if backend == 'numba':
+        if numba is None:
+            raise ImportError('The numba backend requires numba')
+        kernels = _compiled
+    elif backend == 'python':
+        kernels = _python
+    else:
+        raise ValueError('Unknown kernel backend %s' % backend)
+    globals().update(kernels)
+    BACKEND = backend
+
+
+if numba is not None and os.environ.get('ASTEROIDS_KERNELS', 'numba') == 'numba':
+    use('numba')
+else:
+    use('python')
+
+
+def play(backend, frames, n_asteroids, physics):
+    """
+    Play a seeded headless game with the kernels of backend, return the state of every frame.
+    """
+    # The module asteroids uses, not __main__
+    import asteroids
+    import kernels
+
+    kernels.use(backend)
+    game = asteroids.Game(640*2, 480*2, physics=physics, dt=1000 / 60, headless=True, render=False)
+    game.seed = 0
+    game.reset()
+    asteroids.random.seed(0)
+    game.asteroids.add(asteroids.Asteroid.random(game.width, game.height) for _ in range(n_asteroids - 5))
+    # God mode keeps the game from resetting on death
+    game.mode = asteroids.pygame.K_2
+    states = []
+    for frame in range(frames):
+        game.run_once(asteroids.ACTIONS[frame // 30 % len(asteroids.ACTIONS)])
+        states.append([tuple(game.observation)] + [
+            (*sprite.position, *sprite.velocity) for group in game.groups for sprite in group
+        ])
+    return states
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the numba kernels play the same game as plain Python.")
+    parser.add_argument('--frames', type=int, default=2000)
+    parser.add_argument('--asteroids', type=int, default=20)
+    args = parser.parse_args()
+    if numba is None:
+        parser.error('numba is not installed')
+
+    import asteroids
+
+    for physics in sorted(asteroids.Game.physics_modes):
+        python = play('python', args.frames, args.asteroids, physics)
+        compiled = play('numba', args.frames, args.asteroids, physics)
+        for frame, (a, b) in enumerate(zip(python, compiled)):
+            if a != b:
+                raise SystemExit('%s physics: trajectories differ from frame %s' % (physics, frame))
+        print('%s physics: identical trajectories for %s frames' % (physics, args.frames))
+
+
+if __name__ == "__main__":
+    main()
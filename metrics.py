@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Streaming training metrics.
+
+MetricsLogger appends every logged row as a json line from a background
+thread and keeps rolling means of each metric, so the training loop never
+waits for disk or plotting. The plots are drawn by a separate process:
+
+    python metrics.py metrics.jsonl
+"""
+import argparse
+import itertools
+import json
+import math
+import queue
+import threading
+import time
+from collections import deque
+
+
+class Rolling:
+    """
+    Mean over the last window values, updated in constant time.
+    """
+
+    def __init__(self, window):
+        self.values = deque(maxlen=window)
+        self.sum = 0.0
+
+    def add(self, value):
+        if len(self.values) == self.values.maxlen:
+            self.sum -= self.values[0]
+        self.values.append(value)
+        self.sum += value
+
+    @property
+    def mean(self):
+        if not self.values:
+            return math.nan
+        return self.sum / len(self.values)
+
+
+class MetricsLogger:
+    """
+    Log rows of metrics, e.g. logger.log(episode=3, reward=12.0, loss=0.1).
+
+    Rows are buffered in a queue and written to path by a background thread,
+    which flushes at most every flush_every seconds.
+    """
+
+    def __init__(self, path, window=100, flush_every=1.0):
+        self.path = path
+        self.window = window
+        self.flush_every = flush_every
+        self.rolling = {}
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def log(self, **values):
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.rolling.setdefault(name, Rolling(self.window)).add(value)
+        values.setdefault('time', time.time())
+        self.queue.put(values)
+
+    def mean(self, name):
+        """
+        Rolling mean of the last window values of name.
+        """
+        rolling = self.rolling.get(name)
+        return rolling.mean if rolling else math.nan
+
+    def run(self):
+        with open(self.path, 'a') as f:
+            last_flush = time.monotonic()
+            while True:
+                try:
+                    values = self.queue.get(timeout=self.flush_every)
+                except queue.Empty:
+                    values = ()
+                if values is None:
+                    break
+                if values:
+                    f.write(json.dumps(values) + '\n')
+                if time.monotonic() - last_flush >= self.flush_every:
+                    f.flush()
+                    last_flush = time.monotonic()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def read(path, offset=0):
+    """
+    Return (rows, offset) of the complete lines after offset.
+    """
+    rows = []
+    try:
+        f = open(path)
+    except FileNotFoundError:
+        return rows, offset
+    with f:
+        f.seek(offset)
+        for line in iter(f.readline, ''):
+            if not line.endswith('\n'):
+                break
+            rows.append(json.loads(line))
+            offset = f.tell()
+    return rows, offset
+
+
+def view(path, metrics, x, window, interval):
+    """
+    Plot metrics of a log file, following it as it grows.
+    """
+    import matplotlib.pyplot as plt
+
+    rows = []
+    offset = 0
+    figure, axes = plt.subplots(len(metrics), 1, sharex=True, squeeze=False)
+    plt.ion()
+    plt.show()
+    while plt.fignum_exists(figure.number):
+        new_rows, offset = read(path, offset)
+        if new_rows:
+            rows += new_rows
+            for ax, name in zip(axes[:, 0], metrics):
+                points = [(row.get(x, i), row[name]) for i, row in enumerate(rows) if row.get(name) is not None]
+                ax.clear()
+                ax.set_ylabel(name)
+                if not points:
+                    continue
+                xs, ys = zip(*points)
+                ax.plot(xs, ys)
+                if len(ys) >= window:
+                    sums = list(itertools.accumulate(ys, initial=0))
+                    means = [(sums[i] - sums[i - window]) / window for i in range(window, len(ys) + 1)]
+                    ax.plot(xs[window - 1:], means)
+            axes[-1, 0].set_xlabel(x)
+        plt.pause(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plot a metrics log while it is written.")
+    parser.add_argument('path')
+    parser.add_argument('--metrics', nargs='+', default=['reward', 'length', 'loss', 'epsilon', 'steps_per_second'])
+    parser.add_argument('--x', default='episode')
+    parser.add_argument('--window', type=int, default=100)
+    parser.add_argument('--interval', type=float, default=2.0, help="Seconds between refreshes")
+    args = parser.parse_args()
+    view(args.path, args.metrics, args.x, args.window, args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Whisker policies as small NumPy multilayer perceptrons.
+
+A policy is a flat vector of parameters so that a whole population fits in
+one (population, n_params) array, and the forward pass of every member is
+computed at once with batched matrix products.
+"""
+import numpy as np
+
+import asteroids
+
+
+N_WHISKERS = 36
+WHISKER_SIZE = 250
+LAYERS = (N_WHISKERS, 32, len(asteroids.ACTIONS))
+
+
+def n_params(layers=LAYERS):
+    return sum(n_in * n_out + n_out for n_in, n_out in zip(layers[:-1], layers[1:]))
+
+
+def unflatten(population, layers=LAYERS):
+    """
+    Return [(weights, bias), ...] views into a (population, n_params) array,
+    with weights shaped (population, n_in, n_out) and bias (population, n_out).
+    """
+    population = np.asarray(population)
+    params = []
+    i = 0
+    for n_in, n_out in zip(layers[:-1], layers[1:]):
+        weights = population[:, i:i + n_in * n_out].reshape(-1, n_in, n_out)
+        i += n_in * n_out
+        bias = population[:, i:i + n_out]
+        i += n_out
+        params.append((weights, bias))
+    return params
+
+
+def random_population(size, rng, layers=LAYERS):
+    """
+    Initialize size policies with scaled normal weights and zero biases.
+    """
+    population = np.zeros((size, n_params(layers)), dtype=np.float32)
+    for (weights, bias), n_in in zip(unflatten(population, layers), layers[:-1]):
+        weights[...] = rng.standard_normal(weights.shape) / np.sqrt(n_in)
+    return population
+
+
+def observe(whiskers):
+    """
+    Scale Game.observation to [0, 1], 1 meaning an asteroid right next to the player.
+    """
+    return np.asarray(whiskers, dtype=np.float32) / WHISKER_SIZE
+
+
+def forward(params, x):
+    """
+    Batched forward pass, x is (population, n_inputs), returns (population, n_actions) logits.
+    Member i of the population sees row i of x.
+    """
+    for i, (weights, bias) in enumerate(params):
+        x = np.einsum('pi,pio->po', x, weights) + bias
+        if i < len(params) - 1:
+            x = np.tanh(x)
+    return x
+
+
+def act(params, x):
+    """
+    Return the index into asteroids.ACTIONS chosen by each member of the population.
+    """
+    return forward(params, x).argmax(axis=1)
@@ -0,0 +1,94 @@
+import sys
+import time
+
+
+class _Phase:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_phase = _NullPhase()
+
+
+class Profiler:
+    """
+    Wall time and call counts of named phases, e.g.
+
+        with profiler.phase('whiskers'):
+            game.whiskers()
+
+    A disabled profiler hands out a shared no-op phase, so the hooks can stay in the hot path.
+    When dump_every is set, frame() writes the statistics to stream every dump_every frames.
+    """
+
+    def __init__(self, enabled=False, dump_every=0, stream=sys.stderr):
+        self.enabled = enabled
+        self.dump_every = dump_every
+        self.stream = stream
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.seconds = {}
+        self.frames = 0
+
+    def phase(self, name):
+        if not self.enabled:
+            return _null_phase
+        return _Phase(self, name)
+
+    def add(self, name, seconds):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def frame(self):
+        if not self.enabled:
+            return
+        self.frames += 1
+        if self.dump_every and self.frames % self.dump_every == 0:
+            self.dump()
+
+    def stats(self):
+        """
+        Return {phase: {'calls', 'seconds', 'per_frame'}} with per_frame in milliseconds.
+        """
+        return {
+            name: dict(
+                calls=self.calls[name],
+                seconds=self.seconds[name],
+                per_frame=1000 * self.seconds[name] / max(self.frames, 1),
+            )
+            for name in self.calls
+        }
+
+    def dump(self, stream=None):
+        stream = stream or self.stream
+        stats = self.stats()
+        total = sum(s['seconds'] for s in stats.values()) or 1.0
+        stream.write('Profile after %s frames:\n' % self.frames)
+        for name, s in sorted(stats.items(), key=lambda item: -item[1]['seconds']):
+            stream.write('  %-20s %8d calls %9.3f ms/frame %5.1f%%\n' % (
+                name, s['calls'], s['per_frame'], 100 * s['seconds'] / total,
+            ))
+        stream.flush()
@@ -5,66 +5,169 @@ import pygame
 import asteroids
 
 
-import gym
+import argparse
+import json
 import math
+import os
 import random
+import subprocess
+import sys
+import time
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-from collections import namedtuple
-from itertools import count
-from PIL import Image
+from collections import deque
+from itertools import count, islice
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-import torchvision.transforms as T
 
+from metrics import MetricsLogger
 
-env = gym.make('CartPole-v0').unwrapped
 
-# set up matplotlib
-is_ipython = 'inline' in matplotlib.get_backend()
-if is_ipython:
-    from IPython import display
-
-plt.ion()
+METRICS_PATH = 'metrics.jsonl'
 
 # if gpu is to be used
 # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 device = torch.device("cpu")
 
 
-Transition = namedtuple('Transition',
-                        ('state', 'action', 'next_state', 'reward'))
-
-
-class ReplayMemory:
-
-    def __init__(self, capacity):
+BATCH_SIZE = 128
+GAMMA = 0.999
+EPS_START = 0.9
+EPS_END = 0.05
+EPS_DECAY = 200
+TARGET_UPDATE = 10
+REPLAY_CAPACITY = 100000
+# Rewards summed into each target before bootstrapping from the target network
+N_STEPS = 3
+# Let policy_net pick the next action and target_net value it
+DOUBLE_DQN = True
+# Separate state value and action advantage streams in DQN
+DUELING = False
+
+# Observations are the last HISTORY downscaled grayscale frames
+FRAME_SIZE = 84
+HISTORY = 4
+WIDTH, HEIGHT = 640*2, 480*2
+# Frames average every SCREEN_STEP-th pixel of the window
+SCREEN_STEP = 4
+
+# CPU tuning of the learner, see configure_threads and Learner
+COMPILE = False
+# None keeps the torch defaults, leave cores free for environment processes
+INTRA_OP_THREADS = None
+INTER_OP_THREADS = None
+CHANNELS_LAST = True
+BFLOAT16 = False
+
+
+class FrameReplayMemory:
+    """
+    Replay memory that stores every frame once.
+
+    Slot i holds the frame seen before action i together with its reward and
+    whether the episode ended. States are stacks of the last history frames
+    and are rebuilt from slot indices when sampled. Frames from before the
+    start of an episode are zeros.
+
+    Sampled transitions span n_steps actions: the reward is the discounted
+    sum of the next n_steps rewards and the next state is the stack ending
+    at slot i + n_steps, unless the episode ended before that.
+    """
+
+    def __init__(self, capacity, frame_shape, history=HISTORY, n_steps=N_STEPS, gamma=GAMMA):
         self.capacity = capacity
-        self.memory = []
+        self.history = history
+        self.n_steps = n_steps
+        self.gamma = gamma
+        self.frames = np.zeros((capacity, *frame_shape), dtype=np.uint8)
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=bool)
+        self.starts = np.zeros(capacity, dtype=bool)
         self.position = 0
-
-    def push(self, *args):
-        """Saves a transition."""
-        if len(self.memory) < self.capacity:
-            self.memory.append(None)
-        self.memory[self.position] = Transition(*args)
+        self.size = 0
+        self.episode_start = True
+
+    def push(self, frame, action, reward, done):
+        """Saves the frame seen before taking action and what followed."""
+        i = self.position
+        self.frames[i] = frame
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.dones[i] = done
+        self.starts[i] = self.episode_start
+        self.episode_start = done
         self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def stack(self, indices):
+        """
+        Return the (batch, history, *frame_shape) states ending at indices.
+        """
+        states = np.zeros((len(indices), self.history, *self.frames.shape[1:]), dtype=np.uint8)
+        alive = np.ones(len(indices), dtype=bool)
+        for k in range(self.history):
+            slots = (indices - k) % self.capacity
+            states[alive, self.history - 1 - k] = self.frames[slots[alive]]
+            # Older frames belong to the previous episode
+            alive &= ~self.starts[slots]
+        return states
+
+    def valid(self, indices):
+        # The rewards and next frame of the newest slots aren't known before the episode ends
+        newer = (self.position - 1 - indices) % self.capacity
+        valid = newer >= self.n_steps
+        for k in range(self.n_steps):
+            valid |= (k <= newer) & self.dones[(indices + k) % self.capacity]
+        if self.size == self.capacity:
+            # Stacks of the oldest slots would reach frames that were overwritten
+            valid &= (indices - self.position) % self.capacity >= self.history - 1
+        return valid
+
+    def returns(self, indices):
+        """
+        Return the discounted n-step rewards from indices and whether the episode ended on the way.
+        """
+        returns = np.zeros(len(indices), dtype=np.float32)
+        alive = np.ones(len(indices), dtype=bool)
+        for k in range(self.n_steps):
+            slots = (indices + k) % self.capacity
+            returns += alive * self.gamma**k * self.rewards[slots]
+            alive &= ~self.dones[slots]
+        return returns, ~alive
 
     def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
+        """
+        Return (states, actions, returns, next_states, dones) arrays of batch_size transitions.
+        Next states of transitions that are done are meaningless.
+        """
+        indices = np.zeros(0, dtype=np.int64)
+        while len(indices) < batch_size:
+            candidates = np.random.randint(self.size, size=batch_size)
+            indices = np.concatenate([indices, candidates[self.valid(candidates)]])
+        indices = indices[:batch_size]
+        returns, dones = self.returns(indices)
+        next_indices = (indices + self.n_steps) % self.capacity
+        return (
+            self.stack(indices),
+            self.actions[indices],
+            returns,
+            self.stack(next_indices),
+            dones,
+        )
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
+
 
 class DQN(nn.Module):
 
-    def __init__(self, h, w, outputs):
+    def __init__(self, h, w, outputs, channels=HISTORY, dueling=DUELING):
         super(DQN, self).__init__()
-        self.conv1 = nn.Conv2d(3, 16, kernel_size=5, stride=2)
+        self.dueling = dueling
+        self.conv1 = nn.Conv2d(channels, 16, kernel_size=5, stride=2)
         self.bn1 = nn.BatchNorm2d(16)
         self.conv2 = nn.Conv2d(16, 32, kernel_size=5, stride=2)
         self.bn2 = nn.BatchNorm2d(32)
@@ -79,210 +182,337 @@ class DQN(nn.Module):
         convh = conv2d_size_out(conv2d_size_out(conv2d_size_out(h)))
         linear_input_size = convw * convh * 32
         self.head = nn.Linear(linear_input_size, outputs)
+        if dueling:
+            # self.head gives the advantages of the actions
+            self.value = nn.Linear(linear_input_size, 1)
 
     # Called with either one element to determine next action, or a batch
-    # during optimization. Returns tensor([[left0exp,right0exp]...]).
+    # during optimization. Returns tensor([[action0exp,action1exp]...]).
     def forward(self, x):
         x = F.relu(self.bn1(self.conv1(x)))
         x = F.relu(self.bn2(self.conv2(x)))
         x = F.relu(self.bn3(self.conv3(x)))
-        return self.head(x.view(x.size(0), -1))
-
-
-resize = T.Compose([T.ToPILImage(),
-                    T.Resize(40, interpolation=Image.CUBIC),
-                    T.ToTensor()])
-
-
-def get_cart_location(screen_width):
-    world_width = env.x_threshold * 2
-    scale = screen_width / world_width
-    return int(env.state[0] * scale + screen_width / 2.0)  # MIDDLE OF CART
-
-def get_screen():
-    # Returned screen requested by gym is 400x600x3, but is sometimes larger
-    # such as 800x1200x3. Transpose it into torch order (CHW).
-    screen = env.render(mode='rgb_array').transpose((2, 0, 1))
-    # Cart is in the lower half, so strip off the top and bottom of the screen
-    _, screen_height, screen_width = screen.shape
-    screen = screen[:, int(screen_height*0.4):int(screen_height * 0.8)]
-    view_width = int(screen_width * 0.6)
-    cart_location = get_cart_location(screen_width)
-    if cart_location < view_width // 2:
-        slice_range = slice(view_width)
-    elif cart_location > (screen_width - view_width // 2):
-        slice_range = slice(-view_width, None)
-    else:
-        slice_range = slice(cart_location - view_width // 2,
-                            cart_location + view_width // 2)
-    # Strip off the edges, so that we have a square image centered on a cart
-    screen = screen[:, :, slice_range]
-    # Convert to float, rescale, convert to torch tensor
-    # (this doesn't require a copy)
-    screen = np.ascontiguousarray(screen, dtype=np.float32) / 255
-    screen = torch.from_numpy(screen)
-    # Resize, and add a batch dimension (BCHW)
-    return resize(screen).unsqueeze(0).to(device)
-
-
-env.reset()
-plt.figure()
-plt.imshow(get_screen().cpu().squeeze(0).permute(1, 2, 0).numpy(),
-           interpolation='none')
-plt.title('Example extracted screen')
-plt.show()
-
-
-BATCH_SIZE = 128
-GAMMA = 0.999
-EPS_START = 0.9
-EPS_END = 0.05
-EPS_DECAY = 200
-TARGET_UPDATE = 10
-
-# Get screen size so that we can initialize layers correctly based on shape
-# returned from AI gym. Typical dimensions at this point are close to 3x40x90
-# which is the result of a clamped and down-scaled render buffer in get_screen()
-init_screen = get_screen()
-_, _, screen_height, screen_width = init_screen.shape
-
-# Get number of actions from gym action space
-n_actions = env.action_space.n
-
-policy_net = DQN(screen_height, screen_width, n_actions).to(device)
-target_net = DQN(screen_height, screen_width, n_actions).to(device)
-target_net.load_state_dict(policy_net.state_dict())
-target_net.eval()
-
-optimizer = optim.RMSprop(policy_net.parameters())
-memory = ReplayMemory(10000)
-
-
-steps_done = 0
-
-
-def select_action(state):
-    global steps_done
-    sample = random.random()
-    eps_threshold = EPS_END + (EPS_START - EPS_END) * \
-        math.exp(-1. * steps_done / EPS_DECAY)
-    steps_done += 1
-    if sample > eps_threshold:
-        with torch.no_grad():
-            # t.max(1) will return largest column value of each row.
-            # second column on max result is index of where max element was
-            # found, so we pick action with the larger expected reward.
-            return policy_net(state).max(1)[1].view(1, 1)
-    else:
-        return torch.tensor([[random.randrange(n_actions)]], device=device, dtype=torch.long)
-
-
-episode_durations = []
-
-
-def plot_durations():
-    plt.figure(2)
-    plt.clf()
-    durations_t = torch.tensor(episode_durations, dtype=torch.float)
-    plt.title('Training...')
-    plt.xlabel('Episode')
-    plt.ylabel('Duration')
-    plt.plot(durations_t.numpy())
-    # Take 100 episode averages and plot them too
-    if len(durations_t) >= 100:
-        means = durations_t.unfold(0, 100, 1).mean(1).view(-1)
-        means = torch.cat((torch.zeros(99), means))
-        plt.plot(means.numpy())
-
-    plt.pause(0.001)  # pause a bit so that plots are updated
-    if is_ipython:
-        display.clear_output(wait=True)
-        display.display(plt.gcf())
-
-
-def optimize_model():
-    if len(memory) < BATCH_SIZE:
-        return
-    transitions = memory.sample(BATCH_SIZE)
-    # Transpose the batch (see https://stackoverflow.com/a/19343/3343043 for
-    # detailed explanation). This converts batch-array of Transitions
-    # to Transition of batch-arrays.
-    batch = Transition(*zip(*transitions))
-
-    # Compute a mask of non-final states and concatenate the batch elements
-    # (a final state would've been the one after which simulation ended)
-    non_final_mask = torch.tensor(tuple(map(lambda s: s is not None,
-                                          batch.next_state)), device=device, dtype=torch.bool)
-    non_final_next_states = torch.cat([s for s in batch.next_state
-                                                if s is not None])
-    state_batch = torch.cat(batch.state)
-    action_batch = torch.cat(batch.action)
-    reward_batch = torch.cat(batch.reward)
-
-    # Compute Q(s_t, a) - the model computes Q(s_t), then we select the
-    # columns of actions taken. These are the actions which would've been taken
-    # for each batch state according to policy_net
-    state_action_values = policy_net(state_batch).gather(1, action_batch)
-
-    # Compute V(s_{t+1}) for all next states.
-    # Expected values of actions for non_final_next_states are computed based
-    # on the "older" target_net; selecting their best reward with max(1)[0].
-    # This is merged based on the mask, such that we'll have either the expected
-    # state value or 0 in case the state was final.
-    next_state_values = torch.zeros(BATCH_SIZE, device=device)
-    next_state_values[non_final_mask] = target_net(non_final_next_states).max(1)[0].detach()
-    # Compute the expected Q values
-    expected_state_action_values = (next_state_values * GAMMA) + reward_batch
-
-    # Compute Huber loss
-    loss = F.smooth_l1_loss(state_action_values, expected_state_action_values.unsqueeze(1))
-
-    # Optimize the model
-    optimizer.zero_grad()
-    loss.backward()
-    for param in policy_net.parameters():
-        param.grad.data.clamp_(-1, 1)
-    optimizer.step()
-
-num_episodes = 1000
-for i_episode in range(num_episodes):
-    # Initialize the environment and state
-    env.reset()
-    last_screen = get_screen()
-    current_screen = get_screen()
-    state = current_screen - last_screen
-    for t in count():
-        # Select and perform an action
-        action = select_action(state)
-        _, reward, done, _ = env.step(action.item())
-        reward = torch.tensor([reward], device=device)
-
-        # Observe new state
-        last_screen = current_screen
-        current_screen = get_screen()
-        if not done:
-            next_state = current_screen - last_screen
+        # flatten copies channels last activations back into the logical order
+        x = x.flatten(1)
+        if not self.dueling:
+            return self.head(x)
+        advantage = self.head(x)
+        return self.value(x) + advantage - advantage.mean(1, keepdim=True)
+
+
+# Averaging matrices of screen, by window and frame size
+_filters = {}
+
+
+def box_filter(samples, size):
+    """
+    Return a (size, samples) matrix that averages samples values into size bins.
+    """
+    matrix = np.zeros((size, samples), dtype=np.float32)
+    matrix[np.arange(samples) * size // samples, np.arange(samples)] = 1
+    return matrix / matrix.sum(axis=1, keepdims=True)
+
+
+def screen(window, frame_size=FRAME_SIZE):
+    """
+    Downscale the window into a (frame_size, frame_size) grayscale frame.
+    """
+    width, height = window.get_size()
+    key = (width, height, frame_size)
+    if key not in _filters:
+        _filters[key] = (
+            box_filter(math.ceil(height / SCREEN_STEP), frame_size),
+            box_filter(math.ceil(width / SCREEN_STEP), frame_size).T,
+        )
+    rows, columns = _filters[key]
+    # Red is the brightest channel of every sprite color, and pixels_red references the window without copying
+    red = pygame.surfarray.pixels_red(window)
+    samples = red.T[::SCREEN_STEP, ::SCREEN_STEP].astype(np.float32)
+    del red
+    # Averaging the sampled pixels into bins keeps the thin lines of the sprites visible
+    return (rows @ samples @ columns).astype(np.uint8)
+
+
+class AsteroidsEnv:
+    """
+    Headless asteroids with downscaled grayscale frames as observations.
+    """
+
+    def __init__(self, frame_size=FRAME_SIZE, history=HISTORY):
+        self.game = asteroids.Game(WIDTH, HEIGHT, dt=1000 / 60, headless=True)
+        self.frame_size = frame_size
+        self.frames = deque(maxlen=history)
+        self.n_actions = len(asteroids.ACTIONS)
+
+    def get_screen(self):
+        return screen(self.game.window, self.frame_size)
+
+    def reset(self):
+        # A new start state every episode
+        self.game.seed = random.randrange(2**31)
+        self.game.reset()
+        self.game.draw()
+        self.game.whiskers()
+        frame = self.get_screen()
+        self.frames.extend(np.zeros_like(frame) for _ in range(self.frames.maxlen))
+        self.frames.append(frame)
+        return frame
+
+    def step(self, action):
+        reward, done, _ = self.game.run_once(action)
+        frame = self.get_screen()
+        self.frames.append(frame)
+        return frame, reward, done
+
+    def state(self):
+        """The stacked frames as a (1, history, h, w) tensor for the network."""
+        return to_tensor(np.stack(self.frames)[None])
+
+
+def to_tensor(frames):
+    return torch.from_numpy(frames).to(device=device, dtype=torch.float32) / 255
+
+
+def configure_threads(intra=INTRA_OP_THREADS, inter=INTER_OP_THREADS):
+    """
+    Set the torch thread pools, None keeps the default.
+    """
+    if intra:
+        torch.set_num_threads(intra)
+    if inter:
+        try:
+            torch.set_num_interop_threads(inter)
+        except RuntimeError:
+            # Only possible before the first parallel work of the process
+            print('Inter-op threads already started, keeping %s' % torch.get_num_interop_threads())
+
+
+def bfloat16_supported():
+    """
+    Whether the CPU runs bfloat16 convolutions natively, emulated they are slower than float32.
+    """
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class Learner:
+    """
+    DQN learner tuned for CPUs.
+
+    channels_last stores activations in the layout the oneDNN convolutions
+    prefer, bfloat16 runs the forward passes under autocast where the CPU
+    supports it and compile hands both networks to torch.compile.
+    """
+
+    def __init__(self, n_actions, frame_size=FRAME_SIZE, batch_size=BATCH_SIZE, gamma=GAMMA,
+                 eps_start=EPS_START, eps_end=EPS_END, eps_decay=EPS_DECAY,
+                 replay_capacity=REPLAY_CAPACITY, n_steps=N_STEPS, compile=COMPILE,
+                 channels_last=CHANNELS_LAST, bfloat16=BFLOAT16):
+        self.n_actions = n_actions
+        self.batch_size = batch_size
+        self.gamma = gamma
+        self.eps_start, self.eps_end, self.eps_decay = eps_start, eps_end, eps_decay
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.bfloat16 = bfloat16 and bfloat16_supported()
+        self.policy_net = DQN(frame_size, frame_size, n_actions, dueling=DUELING).to(device, memory_format=self.memory_format)
+        self.target_net = DQN(frame_size, frame_size, n_actions, dueling=DUELING).to(device, memory_format=self.memory_format)
+        self.target_net.load_state_dict(self.policy_net.state_dict())
+        self.target_net.eval()
+
+        # The compiled modules share their parameters with the networks
+        if compile:
+            self.policy_forward = torch.compile(self.policy_net)
+            self.target_forward = torch.compile(self.target_net)
+        else:
+            self.policy_forward = self.policy_net
+            self.target_forward = self.target_net
+
+        self.optimizer = optim.RMSprop(self.policy_net.parameters())
+        self.memory = FrameReplayMemory(replay_capacity, (frame_size, frame_size), n_steps=n_steps, gamma=gamma)
+        self.steps_done = 0
+
+    def epsilon(self):
+        return self.eps_end + (self.eps_start - self.eps_end) * \
+            math.exp(-1. * self.steps_done / self.eps_decay)
+
+    def select_action(self, state):
+        sample = random.random()
+        eps_threshold = self.epsilon()
+        self.steps_done += 1
+        if sample > eps_threshold:
+            with torch.no_grad():
+                # t.max(1) will return largest column value of each row.
+                # second column on max result is index of where max element was
+                # found, so we pick action with the larger expected reward.
+                return self.policy_net(state).max(1)[1].item()
         else:
-            next_state = None
-
-        # Store the transition in memory
-        memory.push(state, action, next_state, reward)
-
-        # Move to the next state
-        state = next_state
-
-        # Perform one step of the optimization (on the target network)
-        optimize_model()
-        if done:
-            episode_durations.append(t + 1)
-            plot_durations()
-            break
-    # Update the target network, copying all weights and biases in DQN
-    if i_episode % TARGET_UPDATE == 0:
-        target_net.load_state_dict(policy_net.state_dict())
-
-print('Complete')
-env.render()
-env.close()
-plt.ioff()
-plt.show()
\ No newline at end of file
+            return random.randrange(self.n_actions)
+
+    def optimize_model(self):
+        """
+        Do one gradient step, return (loss, mean Q(s_t, a)) or None while the memory fills up.
+        """
+        if len(self.memory) < self.batch_size:
+            return None
+        states, actions, returns, next_states, dones = self.memory.sample(self.batch_size)
+        state_batch = to_tensor(states).contiguous(memory_format=self.memory_format)
+        next_state_batch = to_tensor(next_states).contiguous(memory_format=self.memory_format)
+        action_batch = torch.from_numpy(actions).to(device).unsqueeze(1)
+        return_batch = torch.from_numpy(returns).to(device)
+        non_final_mask = torch.from_numpy(~dones).to(device)
+
+        # Compute Q(s_t, a) - the model computes Q(s_t), then we select the
+        # columns of actions taken. These are the actions which would've been taken
+        # for each batch state according to policy_net
+        with self.autocast():
+            state_action_values = self.policy_forward(state_batch).float().gather(1, action_batch)
+
+        # Compute V(s_{t+n}) for all next states with the "older" target_net.
+        # Double DQN lets policy_net choose the action that target_net values,
+        # otherwise the best action of target_net is selected with max(1)[0].
+        # Final states are masked to 0, their next state belongs to another episode.
+        with torch.no_grad(), self.autocast():
+            next_q_values = self.target_forward(next_state_batch).float()
+            if DOUBLE_DQN:
+                # In eval mode, choosing the actions must not update the BatchNorm running statistics
+                self.policy_net.eval()
+                next_actions = self.policy_forward(next_state_batch).argmax(1, keepdim=True)
+                self.policy_net.train()
+                next_state_values = next_q_values.gather(1, next_actions).squeeze(1)
+            else:
+                next_state_values = next_q_values.max(1)[0]
+            next_state_values = next_state_values * non_final_mask
+        # Compute the expected Q values, returns already hold the n discounted rewards
+        expected_state_action_values = (next_state_values * self.gamma**self.memory.n_steps) + return_batch
+
+        # Compute Huber loss
+        loss = F.smooth_l1_loss(state_action_values, expected_state_action_values.unsqueeze(1))
+
+        # Optimize the model
+        self.optimizer.zero_grad()
+        loss.backward()
+        torch.nn.utils.clip_grad_value_(self.policy_net.parameters(), 1, foreach=True)
+        self.optimizer.step()
+        return loss.item(), state_action_values.mean().item()
+
+    def autocast(self):
+        return torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.bfloat16)
+
+    def update_target(self):
+        # Copy all weights and biases of the policy network
+        self.target_net.load_state_dict(self.policy_net.state_dict())
+
+    def export(self, path):
+        """
+        Save policy_net as a frozen TorchScript module for agent.FrameAgent.
+        """
+        net = DQN(self.memory.frames.shape[1], self.memory.frames.shape[2], self.n_actions, dueling=DUELING)
+        net.load_state_dict(self.policy_net.state_dict())
+        net.eval()
+        example = torch.zeros((1, self.memory.history) + self.memory.frames.shape[1:])
+        with torch.no_grad():
+            module = torch.jit.freeze(torch.jit.trace(net, example))
+        torch.jit.save(module, path, _extra_files={'agent.json': json.dumps(dict(
+            frame_size=self.memory.frames.shape[1],
+            history=self.memory.history,
+        ))})
+
+
+def train(num_episodes, metrics, target_update=TARGET_UPDATE, **options):
+    """
+    Train for num_episodes, options are passed on to Learner.
+    """
+    env = AsteroidsEnv()
+    learner = Learner(env.n_actions, **options)
+    for _ in islice(episodes(env, learner, metrics, target_update), num_episodes):
+        pass
+    return learner
+
+
+def episodes(env, learner, metrics=None, target_update=TARGET_UPDATE):
+    """
+    Train episode after episode, yielding the reward of each.
+    Training resumes where it stopped when the next episode is asked for.
+    """
+    for i_episode in count():
+        # Initialize the environment and state
+        frame = env.reset()
+        state = env.state()
+        episode_reward = 0.0
+        losses, q_values = [], []
+        start = time.perf_counter()
+        for t in count():
+            # Select and perform an action
+            action = learner.select_action(state)
+            next_frame, reward, done = env.step(action)
+            episode_reward += reward
+
+            # Store the transition in memory, the next state is rebuilt from the next frame
+            learner.memory.push(frame, action, reward, done)
+
+            # Move to the next state
+            frame = next_frame
+            state = env.state()
+
+            # Perform one step of the optimization (on the target network)
+            result = learner.optimize_model()
+            if result is not None:
+                losses.append(result[0])
+                q_values.append(result[1])
+            if done and metrics is not None:
+                metrics.log(
+                    episode=i_episode,
+                    reward=episode_reward,
+                    length=t + 1,
+                    loss=sum(losses) / len(losses) if losses else None,
+                    q_value=sum(q_values) / len(q_values) if q_values else None,
+                    epsilon=learner.epsilon(),
+                    steps_per_second=(t + 1) / (time.perf_counter() - start),
+                )
+            if done:
+                break
+        # Update the target network, copying all weights and biases in DQN
+        if i_episode % target_update == 0:
+            learner.update_target()
+        yield episode_reward
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a DQN on asteroids frames.")
+    parser.add_argument('--episodes', type=int, default=1000)
+    parser.add_argument('--plot', action='store_true', help="Plot the metrics in a separate process, see metrics.py")
+    parser.add_argument('--threads', type=int, default=INTRA_OP_THREADS, help="Intra-op threads of torch")
+    parser.add_argument('--interop-threads', type=int, default=INTER_OP_THREADS, help="Inter-op threads of torch")
+    parser.add_argument('--compile', action='store_true', default=COMPILE, help="Compile the networks with torch.compile")
+    parser.add_argument('--bfloat16', action='store_true', default=BFLOAT16, help="bfloat16 autocast where the CPU supports it")
+    parser.add_argument('--no-channels-last', dest='channels_last', action='store_false', default=CHANNELS_LAST)
+    parser.add_argument('--export', metavar='FILE', help="Save the trained policy for asteroids.py --agent")
+    args = parser.parse_args()
+
+    configure_threads(args.threads, args.interop_threads)
+    if args.bfloat16 and not bfloat16_supported():
+        print('bfloat16 is not supported by this CPU, training in float32')
+
+    metrics = MetricsLogger(METRICS_PATH)
+    viewer = None
+    if args.plot:
+        # The viewer lives next to this file, not necessarily in the working directory
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics.py')
+        viewer = subprocess.Popen([sys.executable, script, METRICS_PATH])
+
+    try:
+        learner = train(args.episodes, metrics, compile=args.compile, channels_last=args.channels_last, bfloat16=args.bfloat16)
+        if args.export:
+            learner.export(args.export)
+    finally:
+        metrics.close()
+        if viewer is not None:
+            viewer.terminate()
+            viewer.wait()
+    print('Complete, mean reward of the last 100 episodes %.2f' % metrics.mean('reward'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Binary trajectory recordings and a viewer for them.
+
+A recording is a small json header followed by fixed size step records,
+so a file of millions of steps is opened as a memory map without reading it:
+
+    game.recorder = TrajectoryRecorder('run.rec', game)
+    ...
+    game.recorder.close()
+
+    python replay.py run.rec --start 1000 --stop 5000
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import pygame
+
+import asteroids
+from vector import Vector as Vec
+
+
+MAGIC = b'ASTREC01'
+HEADER_SIZE = 4096
+
+PLAYER, ASTEROID, BULLET = 0, 1, 2
+
+ENTITY = np.dtype([
+    ('kind', 'u1'),
+    ('radius', 'f4'),
+    ('x', 'f4'),
+    ('y', 'f4'),
+    ('vx', 'f4'),
+    ('vy', 'f4'),
+])
+
+
+def step_dtype(max_entities, n_whiskers):
+    return np.dtype([
+        ('step', 'u8'),
+        ('action', 'i2'),
+        ('reward', 'f4'),
+        ('score', 'i4'),
+        ('die', '?'),
+        ('direction', 'f4', (2,)),
+        ('thrust', '?'),
+        ('invincible', 'f4'),
+        ('n_entities', 'u2'),
+        ('whiskers', 'f4', (n_whiskers,)),
+        ('entities', ENTITY, (max_entities,)),
+    ])
+
+
+class TrajectoryRecorder:
+    """
+    Append the steps of a game to a recording.
+
+    Each step only copies the game state into preallocated column arrays.
+    Once a chunk of steps is full they are packed into step records with
+    array operations and written to the file in one go.
+    Entities above max_entities are left out of the step.
+    """
+
+    def __init__(self, path, game, max_entities=64, chunk_steps=4096):
+        self.max_entities = max_entities
+        self.n_whiskers = len(game.observation)
+        self.dtype = step_dtype(max_entities, self.n_whiskers)
+        self.chunk = np.zeros(chunk_steps, dtype=self.dtype)
+        # step, action, reward, score, die, heading, thrust, invincible, n_asteroids, n_entities
+        self.scalars = np.zeros((chunk_steps, 10))
+        self.whiskers = np.zeros((chunk_steps, self.n_whiskers), dtype=np.float32)
+        # radius, x, y, vx, vy of every entity, positions are the top left corners of the sprites
+        self.entities = np.zeros((chunk_steps, max_entities, 5))
+        self.used = 0
+        self.steps = 0
+
+        header = json.dumps(dict(
+            max_entities=max_entities,
+            n_whiskers=self.n_whiskers,
+            width=game.width,
+            height=game.height,
+        )).encode()
+        assert len(MAGIC) + 4 + len(header) <= HEADER_SIZE, "Recording header too large"
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + len(header).to_bytes(4, 'little') + header)
+        self.file.write(b'\0' * (HEADER_SIZE - self.file.tell()))
+
+    def record(self, game, action, reward, die):
+        if action is None:
+            action = -1
+        elif isinstance(action, asteroids.Action):
+            action = asteroids.ACTIONS.index(action)
+
+        player = game.player
+        sprites = [player, *game.asteroids, *game.bullets][:self.max_entities]
+        used = self.used
+        self.scalars[used] = (
+            self.steps, action, reward, player.score, die, player.heading,
+            player.thrust, player.invincible, len(game.asteroids), len(sprites),
+        )
+        self.whiskers[used] = game.observation
+        # Unpacking the values lists skips the slow iteration of Vector
+        self.entities[used, :len(sprites)] = [
+            (sprite.radius, *sprite.position.values, *sprite.velocity.values) for sprite in sprites
+        ]
+
+        self.used += 1
+        self.steps += 1
+        if self.used == len(self.chunk):
+            self.flush()
+
+    def pack(self):
+        """
+        Fill the step records of the chunk from the columns of the recorded steps.
+        """
+        used = self.used
+        chunk = self.chunk[:used]
+        scalars = self.scalars[:used].T
+        for name, column in zip(('step', 'action', 'reward', 'score', 'die'), scalars):
+            chunk[name] = column
+        chunk['direction'] = asteroids.HEADING_VECTORS[scalars[5].astype(int)]
+        chunk['thrust'] = scalars[6]
+        chunk['invincible'] = scalars[7]
+        chunk['n_entities'] = scalars[9]
+        chunk['whiskers'] = self.whiskers[:used]
+
+        entities = chunk['entities']
+        radius, x, y, vx, vy = np.moveaxis(self.entities[:used], 2, 0)
+        index = np.arange(self.max_entities)
+        n_asteroids, n_entities = scalars[8][:, None], scalars[9][:, None]
+        entities['kind'] = np.where(index == 0, PLAYER, np.where(index <= n_asteroids, ASTEROID, BULLET))
+        entities['kind'][index >= n_entities] = 0
+        entities['radius'] = radius
+        entities['x'] = x + radius
+        entities['y'] = y + radius
+        entities['vx'] = vx
+        entities['vy'] = vy
+        # Unused entity slots stay zero, as the rows of a fresh chunk
+        self.entities[:used] = 0
+
+    def flush(self):
+        self.pack()
+        self.file.write(self.chunk[:self.used].tobytes())
+        self.file.flush()
+        self.used = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class Trajectory:
+    """
+    Memory mapped view of a recording, indexable like an array of steps.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            start = f.read(HEADER_SIZE)
+        if start[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a trajectory recording' % path)
+        length = int.from_bytes(start[len(MAGIC):len(MAGIC) + 4], 'little')
+        self.header = json.loads(start[len(MAGIC) + 4:len(MAGIC) + 4 + length])
+        self.dtype = step_dtype(self.header['max_entities'], self.header['n_whiskers'])
+
+        # A recording that wasn't closed may end with a partial step
+        n_steps = (os.path.getsize(path) - HEADER_SIZE) // self.dtype.itemsize
+        if n_steps:
+            self.steps = np.memmap(path, dtype=self.dtype, mode='r', offset=HEADER_SIZE, shape=(n_steps,))
+        else:
+            self.steps = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, key):
+        return self.steps[key]
+
+
+class Viewer:
+    """
+    Draw recorded steps with the sprites and drawing code of asteroids.Game.
+    """
+
+    def __init__(self, trajectory, fps=60):
+        self.trajectory = trajectory
+        self.game = asteroids.Game(trajectory.header['width'], trajectory.header['height'])
+        self.game.fps = fps
+        self.pools = {ASTEROID: {}, BULLET: {}}
+
+    def sprite(self, kind, radius, used):
+        """
+        Return a sprite from the pool of kind and radius, creating one when all are in use.
+        """
+        pool = self.pools[kind].setdefault(radius, [])
+        index = used.get((kind, radius), 0)
+        used[(kind, radius)] = index + 1
+        if index == len(pool):
+            if kind == ASTEROID:
+                pool.append(asteroids.Asteroid(pos=[0, 0], velocity=[0, 0], radius=radius))
+            else:
+                pool.append(asteroids.Bullet(pos=[0, 0], velocity=[0, 0]))
+        return pool[index]
+
+    def load(self, step):
+        game = self.game
+        player = game.player
+        used = {}
+        game.asteroids.empty()
+        game.bullets.empty()
+        for entity in step['entities'][:step['n_entities']]:
+            kind, radius = int(entity['kind']), float(entity['radius'])
+            if kind == PLAYER:
+                sprite = player
+            else:
+                sprite = self.sprite(kind, radius, used)
+                (game.asteroids if kind == ASTEROID else game.bullets).add(sprite)
+            sprite.origin = float(entity['x']), float(entity['y'])
+            sprite.velocity = Vec(float(entity['vx']), float(entity['vy']))
+
+        player.score = int(step['score'])
+        player.invincible = float(step['invincible'])
+        player.direction = Vec(*(float(v) for v in step['direction']))
+        # Setting thrust redraws the ship with the new direction
+        player.thrust = bool(step['thrust'])
+
+    def show(self, start=0, stop=None):
+        game = self.game
+        for i in range(start, min(stop or len(self.trajectory), len(self.trajectory))):
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    return
+            self.load(self.trajectory[i])
+            game.draw()
+            game.whiskers()
+            pygame.display.update()
+            game.clock.tick(game.fps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a trajectory recording.")
+    parser.add_argument('path')
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--stop', type=int)
+    parser.add_argument('--fps', type=int, default=60)
+    args = parser.parse_args()
+
+    trajectory = Trajectory(args.path)
+    print('%s steps' % len(trajectory))
+    Viewer(trajectory, fps=args.fps).show(args.start, args.stop)
+
+
+if __name__ == "__main__":
+    main()
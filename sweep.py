@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Hyperparameter sweeps of qnet_learn with successive halving.
+
+Every configuration is trained for a few episodes in its own process. After
+each rung only the best 1/eta of the trials keep training, for eta times as
+many episodes. Scores are appended to a results file, and a rerun skips
+every rung that has already been scored:
+
+    python sweep.py --grid batch_size=32,128 gamma=0.99,0.999 eps_decay=200,2000 --workers 8
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import random
+from multiprocessing.connection import wait
+
+import numpy as np
+
+import qnet_learn
+from metrics import read
+
+
+RESULTS_PATH = 'sweep.jsonl'
+
+
+def run_trial(config, seed, conn):
+    """
+    Train one configuration as told by the sweep.
+
+    Receives (play, score) to train play more episodes and send back the
+    mean reward of the last score of them, or None to stop.
+    """
+    import torch
+
+    # Trials share the cores, one thread each
+    qnet_learn.configure_threads(1)
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    options = dict(config)
+    target_update = options.pop('target_update', qnet_learn.TARGET_UPDATE)
+    env = qnet_learn.AsteroidsEnv()
+    learner = qnet_learn.Learner(env.n_actions, **options)
+    rewards = qnet_learn.episodes(env, learner, target_update=target_update)
+    for play, score in iter(conn.recv, None):
+        played = [next(rewards) for _ in range(play)]
+        conn.send(float(np.mean(played[-score:])))
+
+
+class Trial:
+
+    def __init__(self, config, seed):
+        self.config = config
+        self.seed = seed
+        self.key = hashlib.sha1(json.dumps([config, seed], sort_keys=True).encode()).hexdigest()[:12]
+        self.process = None
+        self.conn = None
+        self.played = 0
+
+    def start(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=run_trial, args=(self.config, self.seed, child), daemon=True)
+        self.process.start()
+        child.close()
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process = None
+
+
+def load_results(path):
+    rows, _ = read(path)
+    return {(row['key'], row['episodes']): row['score'] for row in rows}
+
+
+def run_rung(trials, budget, previous, workers, context, results, path, max_live=None):
+    """
+    Train trials up to budget episodes, at most workers at a time, and record their scores.
+
+    Trials that finished the rung keep their process paused for the next rung,
+    as long as no more than max_live processes (at least workers) are alive.
+    Starting another trial beyond that stops the paused trial with the lowest
+    score, which starts over if it is promoted.
+    """
+    max_live = max(max_live or workers, workers)
+    # Paused trials go first, they continue without a new process
+    waiting = sorted(trials, key=lambda trial: trial.process is None)
+    running = {}
+    finished = []
+    while waiting or running:
+        while waiting and len(running) < workers:
+            trial = waiting.pop(0)
+            if trial.process is None:
+                if sum(other.process is not None for other in trials) >= max_live:
+                    paused = [other for other in finished if other.process is not None]
+                    min(paused, key=lambda other: results[(other.key, budget)]).stop()
+                # Trials that were scored by an earlier run or stopped start over
+                trial.played = 0
+                trial.start(context)
+            trial.conn.send((budget - trial.played, budget - previous))
+            running[trial.conn] = trial
+
+        for conn in wait(list(running)):
+            trial = running.pop(conn)
+            try:
+                score = conn.recv()
+            except EOFError:
+                print('Trial %s %s failed' % (trial.key, trial.config))
+                trial.stop()
+                results[(trial.key, budget)] = -math.inf
+                continue
+            trial.played = budget
+            results[(trial.key, budget)] = score
+            finished.append(trial)
+            with open(path, 'a') as f:
+                f.write(json.dumps(dict(
+                    key=trial.key, config=trial.config, seed=trial.seed, episodes=budget, score=score,
+                )) + '\n')
+
+
+def sweep(configs, budgets, eta=3, workers=1, seed=0, path=RESULTS_PATH, max_live=None):
+    """
+    Successive halving over configs, return the surviving trials with their final scores.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = load_results(path)
+    trials = [Trial(config, seed) for config in configs]
+    survivors = trials
+    try:
+        for rung, budget in enumerate(budgets):
+            previous = budgets[rung - 1] if rung else 0
+            todo = [trial for trial in survivors if (trial.key, budget) not in results]
+            print('Rung %s: %s trials to %s episodes, %s cached' % (rung, len(survivors), budget, len(survivors) - len(todo)))
+            run_rung(todo, budget, previous, workers, context, results, path, max_live)
+
+            survivors = sorted(survivors, key=lambda trial: results[(trial.key, budget)], reverse=True)
+            for trial in survivors:
+                print('  %8.2f  %s' % (results[(trial.key, budget)], trial.config))
+            if rung < len(budgets) - 1:
+                for trial in survivors[max(len(survivors) // eta, 1):]:
+                    trial.stop()
+                survivors = survivors[:max(len(survivors) // eta, 1)]
+    finally:
+        for trial in trials:
+            trial.stop()
+    return [(trial, results[(trial.key, budgets[-1])]) for trial in survivors]
+
+
+def parse_grid(grid):
+    """
+    Turn ['name=1,2', ...] into a dict of value lists, values are parsed as json.
+    """
+    space = {}
+    for item in grid:
+        name, values = item.split('=', 1)
+        space[name] = [json.loads(value) for value in values.split(',')]
+    return space
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep qnet_learn hyperparameters with successive halving.")
+    parser.add_argument('--grid', nargs='+', required=True, metavar='NAME=VALUES',
+                        help="Comma separated values of Learner arguments or target_update")
+    parser.add_argument('--trials', type=int, help="Sample this many configurations of the grid")
+    parser.add_argument('--min-episodes', type=int, default=10, help="Episodes of the first rung")
+    parser.add_argument('--eta', type=int, default=3, help="Keep the best 1/eta trials, and train them eta times longer")
+    parser.add_argument('--rungs', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--max-live', type=int,
+                        help="Trial processes kept alive, at least and by default --workers. Each holds its "
+                             "replay memory, up to %.1f GB with the default capacity, paused ones are stopped "
+                             "and start over when promoted" % (
+                                 qnet_learn.REPLAY_CAPACITY * qnet_learn.FRAME_SIZE**2 / 2**30))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results', default=RESULTS_PATH)
+    args = parser.parse_args()
+
+    space = parse_grid(args.grid)
+    configs = [dict(zip(space, values)) for values in itertools.product(*space.values())]
+    if args.trials and args.trials < len(configs):
+        configs = random.Random(args.seed).sample(configs, args.trials)
+    budgets = [args.min_episodes * args.eta**rung for rung in range(args.rungs)]
+
+    best = sweep(configs, budgets, args.eta, args.workers, args.seed, args.results, args.max_live)
+    print('Best: %.2f %s' % (best[0][1], best[0][0].config))
+
+
+if __name__ == "__main__":
+    main()